@@ -3,6 +3,9 @@ Textwise - Comparación semántica de letras de canciones
 Una sola página, diseño limpio, colores pastel
 """
 
+import contextlib
+import os
+import time
 import streamlit as st
 import numpy as np
 import plotly.express as px
@@ -13,10 +16,30 @@ from src import (
     embedding_exists,
     compute_similarity_matrix,
     find_most_similar,
+    near_duplicate_groups,
+    top_k_cells,
+    NeighborIndex,
+    IVFIndex,
+    ArtistIndex,
+    most_similar_artists,
     calc_phrase_similarity,
+    calc_line_similarity,
+    load_line_embeddings,
+    line_embeddings_exist,
     split_into_sentences,
-    clean_lyrics
+    PhraseEmbeddingCache,
+    load_embedding_store,
+    embedding_store_exists,
+    ingest_raw_data,
+    encode_query,
+    semantic_search,
+    SongSearchIndex,
+    pool_heatmap
 )
+from src.heatmap import MAX_CELLS
+from src.embeddings import DEFAULT_MODEL, load_manifest
+from src import metrics
+from src.artifacts import EMBEDDINGS_FILE, ArtifactMismatchError, artifact_dir, validate_embeddings
 
 # ============================================================
 # CONFIG
@@ -28,6 +51,10 @@ st.set_page_config(
     layout="wide"
 )
 
+# Lo que depende de la versión (artifacts) se queda en memoria para la versión actual y la anterior
+# (reruns que empezaron antes del cambio); las más viejas se sueltan en vez de acumularse
+VERSIONS_IN_MEMORY = 2
+
 # ============================================================
 # ESTILOS PASTEL
 # ============================================================
@@ -148,323 +175,480 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ============================================================
-# CARGA DE DATOS
+# MÉTRICAS (TEXTWISE_METRICS=1 para activarlas, TEXTWISE_PROFILE=1 para un cProfile del rerun)
 # ============================================================
 
-@st.cache_data
-def load_data():
-    return load_songs("data/songs.csv")
-
-@st.cache_data
-def load_song_embeddings():
-    return show_embeddings("embeddings/song_embeddings.npy")
-
-@st.cache_data
-def get_similarity_matrix(_embeddings):
-    return compute_similarity_matrix(_embeddings)
-
-@st.cache_resource
-def get_model():
-    return load_model()
-
-# ============================================================
-# INICIALIZACIÓN
-# ============================================================
-
-if not embedding_exists("embeddings/song_embeddings.npy"):
-    st.error("⚠️ No se encontraron embeddings. Ejecuta: `python scripts/generate_embeddings.py`")
-    st.stop()
-
-df = load_data()
-embeddings = load_song_embeddings()
-similarity_matrix = get_similarity_matrix(embeddings)
-
-# ============================================================
-# HEADER
-# ============================================================
+def rerun_metrics():
+    # Se cierra aunque el rerun termine con st.stop() o lo corte un nuevo rerun de Streamlit
+    stack = contextlib.ExitStack()
+    if metrics.is_enabled():
+        # Archivo para el textfile collector de node_exporter (se escribe al final, después del timer)
+        stack.callback(metrics.write_prometheus, "metrics/app.prom")
+    stack.enter_context(metrics.timed("app_rerun"))
+    if os.environ.get("TEXTWISE_PROFILE") == "1":
+        # Un solo cProfile por proceso: si otra sesión se está perfilando, este rerun no se perfila
+        stack.enter_context(metrics.profile(f"profiles/app-{time.strftime('%Y%m%d-%H%M%S')}.prof"))
+    return stack
+
+with rerun_metrics():
+
+    # ============================================================
+    # CARGA DE DATOS
+    # ============================================================
+
+    @st.cache_resource
+    def load_data():
+        # cache_resource: el SongCatalog (con sus índices) se comparte, cache_data lo copiaría en cada rerun
+        # Solo se re-ingesta si cambiaron los CSV de data/raw_data
+        ingest_raw_data("data/raw_data", "data/cache/songs")
+        return load_songs(
+            "data/cache/songs",
+            columns=["Artist", "Title", "Album", "Year", "song_key", "display_title", "clean_lyric"]
+        )
 
-st.markdown("<h1>🎵 Textwise</h1>", unsafe_allow_html=True)
-st.markdown("<p style='text-align: center; color: #6b5b7a; font-size: 18px;'>Descubre qué canciones se parecen entre sí</p>", unsafe_allow_html=True)
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def load_song_embeddings(artifacts):
+        # Memory-map: los workers comparten las mismas páginas (cache_data haría una copia).
+        # artifacts es la carpeta de la versión actual: si CURRENT cambia, se carga la nueva
+        if embedding_store_exists(f"{artifacts}/song_embeddings_int8"):
+            return load_embedding_store(f"{artifacts}/song_embeddings_int8")
+        return show_embeddings(f"{artifacts}/{EMBEDDINGS_FILE}", mmap=True)
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def check_embeddings(artifacts):
+        # Mismo modelo, mismas canciones en el mismo orden y mismas letras; si no, el mensaje del error
+        df = load_data()
+        try:
+            validate_embeddings(
+                f"{artifacts}/{EMBEDDINGS_FILE}",
+                embeddings=show_embeddings(f"{artifacts}/{EMBEDDINGS_FILE}", mmap=True),
+                song_keys=df["song_key"].tolist(),
+                lyrics=df["clean_lyric"].tolist(),
+                model_name=DEFAULT_MODEL
+            )
+        except ArtifactMismatchError as e:
+            return str(e)
+        return None
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def get_neighbor_index(artifacts, _embeddings):
+        # Índice top-k en vez de la matriz N x N completa
+        if NeighborIndex.exists(f"{artifacts}/neighbors"):
+            return NeighborIndex.load(f"{artifacts}/neighbors")
+        return NeighborIndex.build(_embeddings[:], k=50)
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def get_song_groups(artifacts, _neighbor_index):
+        # work_id (artista + título sin "(Remix)") unido con las letras casi idénticas
+        return near_duplicate_groups(_neighbor_index, threshold=0.97, groups=load_data()["work_id"].to_numpy())
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def get_artist_index(artifacts, _embeddings):
+        # Centroides por artista (scripts/generate_embeddings.py), o se calculan en una pasada
+        if ArtistIndex.exists(f"{artifacts}/artists"):
+            return ArtistIndex.load(f"{artifacts}/artists")
+        return ArtistIndex.build(_embeddings, load_data().column("Artist"))
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def get_line_embeddings(artifacts):
+        # Líneas precalculadas (scripts/generate_embeddings.py --lines), None si no existen
+        if not line_embeddings_exist(f"{artifacts}/lines"):
+            return None
+        line_embeddings, line_offsets = load_line_embeddings(f"{artifacts}/lines")
+        if len(line_offsets) != len(load_data()) + 1:
+            return None
+        return line_embeddings, line_offsets
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def get_ivf(artifacts):
+        # Índices IVF (scripts/generate_embeddings.py --ivf): la búsqueda por tema solo mira unos pocos grupos
+        song_ivf = line_ivf = None
+        if IVFIndex.exists(f"{artifacts}/ivf"):
+            song_ivf = IVFIndex.load(f"{artifacts}/ivf")
+            if len(song_ivf) != len(load_data()):
+                song_ivf = None
+        precomputed = get_line_embeddings(artifacts)
+        if precomputed and IVFIndex.exists(f"{artifacts}/ivf/lines"):
+            line_ivf = IVFIndex.load(f"{artifacts}/ivf/lines")
+            if len(line_ivf) != len(precomputed[0]):
+                line_ivf = None
+        return song_ivf, line_ivf
+
+    @st.cache_resource
+    def get_model():
+        return load_model()
+
+    @st.cache_resource
+    def get_search_index():
+        # Títulos/artistas en minúsculas + índice de trigramas, se construye una vez
+        return SongSearchIndex.from_df(load_data())
+
+    @st.cache_resource
+    def get_query_cache():
+        # Solo memoria (LRU): las búsquedas repetidas no vuelven a pasar por el modelo
+        return PhraseEmbeddingCache(DEFAULT_MODEL, cache_dir=None, max_memory_items=1000)
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def embeddings_normalized(artifacts):
+        # Los embeddings nuevos ya vienen con norma 1 (lo dice el manifest): coseno = producto punto
+        return bool((load_manifest(f"{artifacts}/{EMBEDDINGS_FILE}") or {}).get("normalized"))
+
+    @st.cache_resource(max_entries=VERSIONS_IN_MEMORY)
+    def get_song_norms(artifacts, _embeddings):
+        if embeddings_normalized(artifacts):
+            return None
+        if isinstance(_embeddings, np.ndarray):
+            return np.linalg.norm(_embeddings, axis=1)
+        return None
+
+    @st.cache_resource
+    def get_phrase_cache():
+        # Embeddings de líneas ya vistas, en memoria y en disco
+        return PhraseEmbeddingCache(DEFAULT_MODEL, "embeddings/phrase_cache")
+
+    # ============================================================
+    # INICIALIZACIÓN
+    # ============================================================
+
+    artifacts = str(artifact_dir())
+
+    if not embedding_exists(f"{artifacts}/{EMBEDDINGS_FILE}"):
+        st.error("⚠️ No se encontraron embeddings. Ejecuta: `python scripts/generate_embeddings.py`")
+        st.stop()
+
+    mismatch = check_embeddings(artifacts)
+    if mismatch:
+        st.error(f"⚠️ Los embeddings no corresponden a las canciones actuales: {mismatch}")
+        st.stop()
+
+    df = load_data()
+    embeddings = load_song_embeddings(artifacts)
+    neighbor_index = get_neighbor_index(artifacts, embeddings)
+
+    # ============================================================
+    # HEADER
+    # ============================================================
+
+    st.markdown("<h1>🎵 Textwise</h1>", unsafe_allow_html=True)
+    st.markdown("<p style='text-align: center; color: #6b5b7a; font-size: 18px;'>Descubre qué canciones se parecen entre sí</p>", unsafe_allow_html=True)
+
+    st.markdown("---")
+
+    # ============================================================
+    # PASO 1: SELECCIONAR CANCIÓN
+    # ============================================================
+
+    st.markdown("## 🎤 Paso 1: Elige una canción")
+
+    search_mode = st.radio(
+        "Buscar por",
+        ["🎤 Título o artista", "💭 Tema o letra"],
+        horizontal=True,
+        label_visibility="collapsed"
+    )
+    by_theme = search_mode == "💭 Tema o letra"
 
-st.markdown("---")
+    col1, col2 = st.columns([3, 1])
 
-# ============================================================
-# PASO 1: SELECCIONAR CANCIÓN
-# ============================================================
+    with col1:
+        search = st.text_input(
+            "Buscar",
+            placeholder="💭 Describe un tema: amor a distancia, fiesta..." if by_theme else "🔍 Escribe artista o título...",
+            label_visibility="collapsed"
+        )
 
-st.markdown("## 🎤 Paso 1: Elige una canción")
+    with col2:
+        n_results = st.selectbox("Mostrar", [5, 10, 15, 20], index=1, label_visibility="collapsed")
+
+    # Filtrar
+    if search and by_theme:
+        # Búsqueda semántica: la consulta se codifica una vez y se compara con todas las letras
+        query_vec = encode_query(search, get_model(), cache=get_query_cache())
+        precomputed = get_line_embeddings(artifacts)
+        song_ivf, line_ivf = get_ivf(artifacts)
+        found_songs, found_lines = semantic_search(
+            query_vec,
+            song_ivf if song_ivf is not None else embeddings,
+            n=50,
+            norms=get_song_norms(artifacts, embeddings),
+            line_embeddings=(line_ivf if line_ivf is not None else precomputed[0]) if precomputed else None,
+            line_offsets=precomputed[1] if precomputed else None,
+            n_lines=5,
+            normalized=embeddings_normalized(artifacts)
+        )
+        options = df.column("display_title")[[i for i, _ in found_songs]].tolist()
+    
+        if found_lines:
+            with st.expander("🎯 Líneas que más se parecen a tu búsqueda"):
+                for song, line, score in found_lines:
+                    text = split_into_sentences(df.column("clean_lyric")[song])[line]
+                    st.markdown(f"**{df.column('display_title')[song]}** ({score*100:.0f}%): {text}")
+    elif search:
+        matches = get_search_index().search(search, limit=100)
+        options = df.column("display_title")[matches].tolist()
+    else:
+        options = df["display_title"].tolist()
+
+    if not options:
+        st.warning("No encontré canciones con ese nombre")
+        st.stop()
+
+    selected = st.selectbox(
+        "Canción seleccionada",
+        options,
+        label_visibility="collapsed"
+    )
 
-col1, col2 = st.columns([3, 1])
+    # Info de la canción seleccionada
+    idx1 = df.index_of(selected)
+    song1 = df.record(idx1)
 
-with col1:
-    search = st.text_input("Buscar", placeholder="🔍 Escribe artista o título...", label_visibility="collapsed")
+    col1, col2 = st.columns([1, 2])
 
-with col2:
-    n_results = st.selectbox("Mostrar", [5, 10, 15, 20], index=1, label_visibility="collapsed")
+    with col1:
+        st.markdown(f"""
+        <div class="song-card">
+            <h3 style="margin:0; color:#5a4a78;">🎵 {song1['Title']}</h3>
+            <p style="margin:5px 0; color:#888;">por <strong>{song1['Artist']}</strong></p>
+            <p style="margin:5px 0; color:#aaa; font-size:14px;">💿 {song1['Album']} • 📅 {song1['Year']}</p>
+        </div>
+        """, unsafe_allow_html=True)
 
-# Filtrar
-if search:
-    mask = (
-        df["Title"].str.lower().str.contains(search.lower(), na=False) |
-        df["Artist"].str.lower().str.contains(search.lower(), na=False)
-    )
-    options = df[mask]["display_title"].tolist()
-else:
-    options = df["display_title"].tolist()
-
-if not options:
-    st.warning("No encontré canciones con ese nombre")
-    st.stop()
-
-selected = st.selectbox(
-    "Canción seleccionada",
-    options,
-    label_visibility="collapsed"
-)
+    with col2:
+        with st.expander("📜 Ver letra"):
+            st.markdown(f"<div class='lyrics-container'>{song1['clean_lyric']}</div>", unsafe_allow_html=True)
 
-# Info de la canción seleccionada
-idx1 = df[df["display_title"] == selected].index[0]
-song1 = df.iloc[idx1]
+    st.markdown("---")
 
-col1, col2 = st.columns([1, 2])
+    # ============================================================
+    # PASO 2: VER CANCIONES SIMILARES
+    # ============================================================
 
-with col1:
-    st.markdown(f"""
-    <div class="song-card">
-        <h3 style="margin:0; color:#5a4a78;">🎵 {song1['Title']}</h3>
-        <p style="margin:5px 0; color:#888;">por <strong>{song1['Artist']}</strong></p>
-        <p style="margin:5px 0; color:#aaa; font-size:14px;">💿 {song1['Album']} • 📅 {song1['Year']}</p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown("## 🎯 Paso 2: Canciones similares")
 
-with col2:
-    with st.expander("📜 Ver letra"):
-        st.markdown(f"<div class='lyrics-container'>{clean_lyrics(song1['Lyric'])}</div>", unsafe_allow_html=True)
+    # Un resultado por obra: remixes, versiones en vivo y letras casi idénticas cuentan como una sola
+    similar = find_most_similar(idx1, neighbor_index, n=n_results, groups=get_song_groups(artifacts, neighbor_index), embeddings=embeddings)
 
-st.markdown("---")
+    # Mostrar en grid
+    cols = st.columns(2)
+    similar_songs = df.records([idx for idx, _ in similar], ["Artist", "Title", "display_title"])
+    for i, ((idx, score), s) in enumerate(zip(similar, similar_songs)):
+        pct = score * 100
+    
+        with cols[i % 2]:
+            if st.button(
+                f"🎵 {s['Artist']} - {s['Title']}  ({pct:.0f}%)",
+                key=f"btn_{idx}",
+                use_container_width=True
+            ):
+                st.session_state.song2_idx = idx
 
-# ============================================================
-# PASO 2: VER CANCIONES SIMILARES
-# ============================================================
+    st.markdown("---")
 
-st.markdown("## 🎯 Paso 2: Canciones similares")
+    # ============================================================
+    # PASO 3: COMPARACIÓN FRASE A FRASE
+    # ============================================================
 
-similar = find_most_similar(idx1, similarity_matrix, n=50)
+    st.markdown("## 🔬 Paso 3: Comparación frase a frase")
 
-# Filtrar duplicados/remixes
-filtered = []
-seen = set()
-for idx, score in similar:
-    s = df.iloc[idx]
-    key = f"{s['Artist'].lower()}_{s['Title'].split('(')[0].strip().lower()}"
-    if key not in seen:
-        filtered.append((idx, score))
-        seen.add(key)
+    # Selector de segunda canción
+    if "song2_idx" not in st.session_state:
+        st.session_state.song2_idx = similar[0][0] if similar else None
 
-# Mostrar en grid
-cols = st.columns(2)
-for i, (idx, score) in enumerate(filtered[:n_results]):
-    s = df.iloc[idx]
-    pct = score * 100
-    
-    with cols[i % 2]:
-        if st.button(
-            f"🎵 {s['Artist']} - {s['Title']}  ({pct:.0f}%)",
-            key=f"btn_{idx}",
-            use_container_width=True
-        ):
-            st.session_state.song2_idx = idx
+    # Dropdown para seleccionar también
+    similar_options = [f"{s['display_title']} ({score*100:.0f}%)" for (_, score), s in zip(similar, similar_songs)]
+    similar_indices = [idx for idx, _ in similar]
 
-st.markdown("---")
+    selected_idx2 = st.selectbox(
+        "O elige de la lista:",
+        range(len(similar_options)),
+        format_func=lambda x: similar_options[x],
+        index=0
+    )
 
-# ============================================================
-# PASO 3: COMPARACIÓN FRASE A FRASE
-# ============================================================
+    idx2 = similar_indices[selected_idx2]
+    song2 = df.record(idx2)
 
-st.markdown("## 🔬 Paso 3: Comparación frase a frase")
+    # Mostrar las dos canciones lado a lado
+    col1, col2, col3 = st.columns([2, 1, 2])
 
-# Selector de segunda canción
-if "song2_idx" not in st.session_state:
-    st.session_state.song2_idx = filtered[0][0] if filtered else None
+    with col1:
+        st.markdown(f"""
+        <div class="song-card" style="text-align:center;">
+            <p style="color:#888; margin:0;">CANCIÓN 1</p>
+            <h3 style="color:#5a4a78; margin:10px 0;">{song1['Title']}</h3>
+            <p style="color:#6b5b7a;">{song1['Artist']}</p>
+        </div>
+        """, unsafe_allow_html=True)
 
-# Dropdown para seleccionar también
-similar_options = [f"{df.iloc[idx]['display_title']} ({score*100:.0f}%)" for idx, score in filtered[:n_results]]
-similar_indices = [idx for idx, _ in filtered[:n_results]]
+    with col2:
+        global_sim = compute_similarity_matrix(embeddings[[idx1, idx2]])[0, 1] * 100
+        st.markdown(f"""
+        <div style="text-align:center; padding:20px;">
+            <div class="sim-score">{global_sim:.0f}%</div>
+            <p style="color:#5a4a78; margin-top:10px;">Similitud</p>
+        </div>
+        """, unsafe_allow_html=True)
 
-selected_idx2 = st.selectbox(
-    "O elige de la lista:",
-    range(len(similar_options)),
-    format_func=lambda x: similar_options[x],
-    index=0
-)
+    with col3:
+        st.markdown(f"""
+        <div class="song-card" style="text-align:center;">
+            <p style="color:#888; margin:0;">CANCIÓN 2</p>
+            <h3 style="color:#5a4a78; margin:10px 0;">{song2['Title']}</h3>
+            <p style="color:#6b5b7a;">{song2['Artist']}</p>
+        </div>
+        """, unsafe_allow_html=True)
 
-idx2 = similar_indices[selected_idx2]
-song2 = df.iloc[idx2]
-
-# Mostrar las dos canciones lado a lado
-col1, col2, col3 = st.columns([2, 1, 2])
-
-with col1:
-    st.markdown(f"""
-    <div class="song-card" style="text-align:center;">
-        <p style="color:#888; margin:0;">CANCIÓN 1</p>
-        <h3 style="color:#5a4a78; margin:10px 0;">{song1['Title']}</h3>
-        <p style="color:#6b5b7a;">{song1['Artist']}</p>
-    </div>
-    """, unsafe_allow_html=True)
-
-with col2:
-    global_sim = similarity_matrix[idx1, idx2] * 100
-    st.markdown(f"""
-    <div style="text-align:center; padding:20px;">
-        <div class="sim-score">{global_sim:.0f}%</div>
-        <p style="color:#5a4a78; margin-top:10px;">Similitud</p>
-    </div>
-    """, unsafe_allow_html=True)
-
-with col3:
-    st.markdown(f"""
-    <div class="song-card" style="text-align:center;">
-        <p style="color:#888; margin:0;">CANCIÓN 2</p>
-        <h3 style="color:#5a4a78; margin:10px 0;">{song2['Title']}</h3>
-        <p style="color:#6b5b7a;">{song2['Artist']}</p>
-    </div>
-    """, unsafe_allow_html=True)
-
-# Calcular similitud frase a frase
-phrases1 = split_into_sentences(clean_lyrics(song1['Lyric']))
-phrases2 = split_into_sentences(clean_lyrics(song2['Lyric']))
-
-if phrases1 and phrases2:
-    model = get_model()
-    phrase_matrix = calc_phrase_similarity(phrases1, phrases2, model)
-    
-    # Heatmap
-    st.markdown("### 🗺️ Mapa de similitud")
-    
-    fig = px.imshow(
-        phrase_matrix,
-        x=[f"{i+1}" for i in range(len(phrases2))],
-        y=[f"{i+1}" for i in range(len(phrases1))],
-        color_continuous_scale="RdYlGn",
-        aspect="auto"
-    )
+    # Calcular similitud frase a frase
+    phrases1 = split_into_sentences(song1['clean_lyric'])
+    phrases2 = split_into_sentences(song2['clean_lyric'])
+
+    if phrases1 and phrases2:
+        precomputed = get_line_embeddings(artifacts)
+        if precomputed is not None:
+            # Sin modelo: solo cortar filas ya calculadas
+            phrase_matrix = calc_line_similarity(idx1, idx2, *precomputed)
+        else:
+            model = get_model()
+            phrase_matrix = calc_phrase_similarity(phrases1, phrases2, model, cache=get_phrase_cache())
+    
+        # Heatmap
+        st.markdown("### 🗺️ Mapa de similitud")
+    
+        # Región a mostrar: toda la matriz, o un trozo si se hace zoom
+        n_rows, n_cols = phrase_matrix.shape
+        region = None
+        if max(n_rows, n_cols) > MAX_CELLS:
+            with st.expander("🔎 Acercar una región"):
+                rows = st.slider(f"Líneas de {song1['Title']}", 1, n_rows, (1, n_rows))
+                cols = st.slider(f"Líneas de {song2['Title']}", 1, n_cols, (1, n_cols))
+                mode = st.radio("Cada celda muestra", ["max", "mean"], horizontal=True,
+                                format_func=lambda m: "la mejor pareja" if m == "max" else "el promedio")
+            region = (rows[0] - 1, rows[1], cols[0] - 1, cols[1])
+        else:
+            mode = "max"
+    
+        # Como mucho MAX_CELLS x MAX_CELLS celdas al navegador, sin importar lo largas que sean las canciones
+        heatmap = pool_heatmap(phrase_matrix, mode=mode, region=region)
     
-    fig.update_layout(
-        height=400,
-        xaxis_title=f"Líneas de {song2['Title']}",
-        yaxis_title=f"Líneas de {song1['Title']}",
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)'
-    )
+        fig = px.imshow(
+            heatmap.values.astype(np.float32),  # plotly no tiene arrays float16, float32 va en binario
+            x=heatmap.col_labels,
+            y=heatmap.row_labels,
+            color_continuous_scale="RdYlGn",
+            aspect="auto"
+        )
     
-    st.plotly_chart(fig, use_container_width=True)
+        fig.update_layout(
+            height=400,
+            xaxis_title=f"Líneas de {song2['Title']}",
+            yaxis_title=f"Líneas de {song1['Title']}",
+            paper_bgcolor='rgba(0,0,0,0)',
+            plot_bgcolor='rgba(0,0,0,0)'
+        )
     
-    # Selector de frases
-    st.markdown("### 🔍 Explorar frases")
+        with metrics.timed("plotly_render"):
+            st.plotly_chart(fig, use_container_width=True)
     
-    col1, col2 = st.columns(2)
+        if heatmap.pooled:
+            st.caption("Cada celda agrupa varias líneas; las mejores parejas conservan su valor exacto.")
     
-    with col1:
-        line1 = st.selectbox(
-            f"Línea de {song1['Title']}",
-            range(len(phrases1)),
-            format_func=lambda x: f"Línea {x+1}"
-        )
+        # Selector de frases
+        st.markdown("### 🔍 Explorar frases")
     
-    with col2:
-        line2 = st.selectbox(
-            f"Línea de {song2['Title']}",
-            range(len(phrases2)),
-            format_func=lambda x: f"Línea {x+1}"
-        )
+        col1, col2 = st.columns(2)
     
-    # Mostrar frases seleccionadas
-    sim = phrase_matrix[line1, line2] * 100
+        with col1:
+            line1 = st.selectbox(
+                f"Línea de {song1['Title']}",
+                range(len(phrases1)),
+                format_func=lambda x: f"Línea {x+1}"
+            )
     
-    col1, col2, col3 = st.columns([2, 1, 2])
+        with col2:
+            line2 = st.selectbox(
+                f"Línea de {song2['Title']}",
+                range(len(phrases2)),
+                format_func=lambda x: f"Línea {x+1}"
+            )
     
-    with col1:
-        st.markdown(f"<div class='phrase-box'>{phrases1[line1]}</div>", unsafe_allow_html=True)
+        # Mostrar frases seleccionadas
+        sim = phrase_matrix[line1, line2] * 100
     
-    with col2:
-        color = "#28a745" if sim >= 70 else "#ffc107" if sim >= 40 else "#dc3545"
-        st.markdown(f"""
-        <div style="text-align:center; padding:20px;">
-            <span style="font-size:32px; color:{color}; font-weight:bold;">{sim:.0f}%</span>
-        </div>
-        """, unsafe_allow_html=True)
+        col1, col2, col3 = st.columns([2, 1, 2])
     
-    with col3:
-        st.markdown(f"<div class='phrase-box-alt'>{phrases2[line2]}</div>", unsafe_allow_html=True)
+        with col1:
+            st.markdown(f"<div class='phrase-box'>{phrases1[line1]}</div>", unsafe_allow_html=True)
     
-    # Top frases más similares
-    st.markdown("### 🏆 Frases más similares")
+        with col2:
+            color = "#28a745" if sim >= 70 else "#ffc107" if sim >= 40 else "#dc3545"
+            st.markdown(f"""
+            <div style="text-align:center; padding:20px;">
+                <span style="font-size:32px; color:{color}; font-weight:bold;">{sim:.0f}%</span>
+            </div>
+            """, unsafe_allow_html=True)
     
-    top_indices = np.argsort(phrase_matrix.flatten())[::-1][:5]
+        with col3:
+            st.markdown(f"<div class='phrase-box-alt'>{phrases2[line2]}</div>", unsafe_allow_html=True)
     
-    for rank, flat_idx in enumerate(top_indices, 1):
-        i = flat_idx // phrase_matrix.shape[1]
-        j = flat_idx % phrase_matrix.shape[1]
-        score = phrase_matrix[i, j] * 100
-        
-        with st.expander(f"#{rank} — {score:.0f}% similitud"):
-            c1, c2 = st.columns(2)
-            with c1:
-                st.info(f"**{song1['Title']}** (línea {i+1}):\n\n{phrases1[i]}")
-            with c2:
-                st.success(f"**{song2['Title']}** (línea {j+1}):\n\n{phrases2[j]}")
-
-else:
-    st.warning("Una de las canciones no tiene letra disponible")
-
-# ============================================================
-# MATRIZ GLOBAL (colapsada)
-# ============================================================
-
-st.markdown("---")
-
-with st.expander("🗺️ Ver matriz global de similitud"):
-    st.markdown("Selecciona artistas para comparar todas sus canciones:")
+        # Top frases más similares
+        st.markdown("### 🏆 Frases más similares")
     
-    artists = sorted(df["Artist"].unique().tolist())
-    selected_artists = st.multiselect("Artistas", artists, default=artists[:2])
+        (top_rows, top_cols), top_scores = top_k_cells(phrase_matrix, 5)
     
-    if len(selected_artists) >= 2:
-        # Tomar canciones balanceadas de cada artista
-        songs_per_artist = 15 // len(selected_artists)
-        if songs_per_artist < 3:
-            songs_per_artist = 3
+        for rank, (i, j, score) in enumerate(zip(top_rows, top_cols, top_scores * 100), 1):
         
-        indices = []
-        titles = []
+            with st.expander(f"#{rank} — {score:.0f}% similitud"):
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.info(f"**{song1['Title']}** (línea {i+1}):\n\n{phrases1[i]}")
+                with c2:
+                    st.success(f"**{song2['Title']}** (línea {j+1}):\n\n{phrases2[j]}")
+
+    else:
+        st.warning("Una de las canciones no tiene letra disponible")
+
+    # ============================================================
+    # MATRIZ GLOBAL (colapsada)
+    # ============================================================
+
+    st.markdown("---")
+
+    with st.expander("🗺️ Ver matriz global de similitud"):
+        st.markdown("Selecciona artistas para comparar su estilo (centroide de todas sus canciones):")
+    
+        artist_index = get_artist_index(artifacts, embeddings)
+        artists = sorted(name for name, n in zip(artist_index.names, artist_index.counts) if n > 0)  # sin los que quedaron vacíos
+        selected_artists = st.multiselect("Artistas", artists, default=artists[:2])
+    
+        if len(selected_artists) >= 2:
+            # Tabla artista x artista: una fila por centroide, instantánea a cualquier tamaño
+            fig = px.imshow(
+                artist_index.similarity(selected_artists),
+                x=selected_artists,
+                y=selected_artists,
+                color_continuous_scale="RdYlGn",
+                aspect="auto"
+            )
         
-        for artist in selected_artists:
-            artist_df = df[df["Artist"] == artist].head(songs_per_artist)
-            indices.extend(artist_df.index.tolist())
-            titles.extend(artist_df["display_title"].tolist())
+            fig.update_layout(
+                height=600,
+                xaxis_tickangle=-45
+            )
         
-        # Limitar a 40 máximo
-        indices = indices[:40]
-        titles = titles[:40]
+            st.plotly_chart(fig, use_container_width=True)
         
-        sub_matrix = similarity_matrix[np.ix_(indices, indices)]
-        
-        fig = px.imshow(
-            sub_matrix,
-            x=titles,
-            y=titles,
-            color_continuous_scale="RdYlGn",
-            aspect="auto"
-        )
-        
-        fig.update_layout(
-            height=600,
-            xaxis_tickangle=-45
-        )
-        
-        st.plotly_chart(fig, use_container_width=True)
-
-# Footer
-st.markdown("---")
-st.markdown(f"<p style='text-align:center; color:#888;'>📊 {len(df):,} canciones de {df['Artist'].nunique()} artistas</p>", unsafe_allow_html=True)
\ No newline at end of file
+            spreads = artist_index.spreads
+            st.caption(" • ".join(
+                f"{a}: {artist_index.counts[artist_index.position(a)]} canciones, dispersión {spreads[artist_index.position(a)]:.2f}"
+                for a in selected_artists
+            ))
+    
+        if selected_artists:
+            st.markdown(f"**Artistas más parecidos a {selected_artists[0]}:**")
+            for name, score in most_similar_artists(selected_artists[0], artist_index, n=5):
+                st.markdown(f"- {name} ({score*100:.0f}%)")
+
+    # Footer
+    st.markdown("---")
+    st.markdown(f"<p style='text-align:center; color:#888;'>📊 {len(df):,} canciones de {len(df.group_rows('Artist'))} artistas</p>", unsafe_allow_html=True)
@@ -0,0 +1,10 @@
+'''
+offline, reproducible benchmarks of the src package on synthetic corpora (no model
+download: encoding uses a stub model). results go to benchmarks/results.json
+
+    python -m benchmarks.run --sizes 10k 100k 1m
+    cp benchmarks/results.json benchmarks/baseline.json
+    python -m benchmarks.run --sizes 10k 100k 1m --baseline benchmarks/baseline.json
+
+the last one exits with 1 if a case lost more than --tolerance of its throughput
+'''
@@ -0,0 +1,103 @@
+'''
+synthetic songs and embeddings that look enough like the real ones
+(lyrics with repeated choruses, [tags] and double spaces, artists with many
+songs, clustered unit vectors) to exercise the same code paths at any size.
+everything comes from a seed, so two runs see exactly the same data
+'''
+import hashlib
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+SYLLABLES = ["la", "na", "ba", "lo", "ve", "ni", "ght", "so", "me", "you", "ta", "ke", "ri", "da", "on", "el", "mi", "yeah"]
+
+def parse_size(text: str) -> int:
+    #"10k" -> 10_000, "1m" -> 1_000_000
+    text = text.lower().replace("_", "")
+    factor = {"k": 1_000, "m": 1_000_000}.get(text[-1], 1)
+    return int(float(text.rstrip("km")) * factor)
+
+def make_vocabulary(size: int = 5000, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 4, size=size)
+    words = {"".join(rng.choice(SYLLABLES, size=n)) for n in lengths}
+    return np.array(sorted(words), dtype=object)
+
+def make_lyrics(n_songs: int, seed: int = 0, lines_per_song: tuple = (8, 40), words_per_line: tuple = (3, 10)) -> list[str]:
+    rng = np.random.default_rng(seed)
+    vocab = make_vocabulary(seed=seed)
+    #zipf-ish word frequencies, like real text
+    weights = 1.0 / np.arange(1, len(vocab) + 1)
+    weights /= weights.sum()
+
+    lyrics = []
+    for _ in range(n_songs):
+        n_lines = int(rng.integers(*lines_per_song))
+        lengths = rng.integers(*words_per_line, size=n_lines)
+        words = vocab[rng.choice(len(vocab), size=int(lengths.sum()), p=weights)]
+        cuts = np.cumsum(lengths)[:-1]
+        lines = [" ".join(chunk) for chunk in np.split(words, cuts)]
+        chorus = lines[:3]
+        lines = lines[:n_lines // 2] + ["[Chorus]"] + chorus + lines[n_lines // 2:] + chorus #choruses repeat
+        text = "\n".join(lines)
+        if rng.random() < 0.3:
+            text = text.replace(" ", "  ", 3) + "\n\n"
+        lyrics.append(text)
+    return lyrics
+
+def make_songs(n_songs: int, seed: int = 0, songs_per_artist: int = 60) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_artists = max(1, n_songs // songs_per_artist)
+    artists = np.array([f"Artist {i:05d}" for i in range(n_artists)], dtype=object)
+    titles = [f"Song {i}" + (" (Remix)" if i % 17 == 0 else "") for i in range(n_songs)]
+    return pd.DataFrame({
+        "Artist": artists[rng.integers(0, n_artists, size=n_songs)],
+        "Title": titles,
+        "Album": [f"Album {i // 12}" for i in range(n_songs)],
+        "Year": rng.integers(1990, 2025, size=n_songs).astype(float),
+        "Date": "2020-01-01",
+        "Lyric": make_lyrics(n_songs, seed=seed)
+    })
+
+def write_raw_csvs(df: pd.DataFrame, raw_dir: str, rows_per_file: int = 50_000) -> Path:
+    #same shape as data/raw_data: several csv files that ingest_raw_data merges
+    raw_dir = Path(raw_dir)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    for i, start in enumerate(range(0, len(df), rows_per_file)):
+        df.iloc[start:start + rows_per_file].to_csv(raw_dir / f"synthetic_{i:03d}.csv", index=False)
+    return raw_dir
+
+def make_embeddings(n_rows: int, dim: int = 384, seed: int = 0, n_clusters: int = 256, block_size: int = 65536) -> np.ndarray:
+    #unit vectors around random centers, so neighbors mean something (pure noise has none)
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim), dtype=np.float32)
+    embeddings = np.empty((n_rows, dim), dtype=np.float32)
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        block = centers[rng.integers(0, n_clusters, size=stop - start)]
+        block += 0.8 * rng.standard_normal(block.shape, dtype=np.float32)
+        embeddings[start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return embeddings
+
+
+class StubModel:
+    #stands in for SentenceTransformer: same text -> same vector, ~cost_ms per text, no download
+    def __init__(self, dim: int = 384, cost_ms: float = 0.0):
+        self.dim = dim
+        self.cost_ms = cost_ms
+        self.max_seq_length = 256
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        if self.cost_ms:
+            time.sleep(self.cost_ms * len(texts) / 1000)
+        seeds = np.array([int(hashlib.md5(t.encode("utf-8")).hexdigest()[:8], 16) for t in texts], dtype=np.uint64)
+        #cheap deterministic vectors: a few rounds of an integer hash, then scaled to [-1, 1)
+        x = seeds[:, None] * np.uint64(0x9E3779B97F4A7C15) + np.arange(self.dim, dtype=np.uint64) * np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(31)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(29)
+        return ((x >> np.uint64(40)).astype(np.float32) / float(1 << 23) - 1.0)
@@ -0,0 +1,209 @@
+'''
+times the core src functions on synthetic corpora and writes the results to json.
+every case is timed (best of --repeat) and then run once more under tracemalloc
+for its peak memory. with --baseline, throughput is compared against a stored
+run and the exit code is 1 if anything got slower than --tolerance allows.
+
+text cases (ingest/load_songs, clean, split, encode) are capped at --text-max
+songs because generating the lyrics is itself slow; vector cases use the full size.
+the O(N^2) ones (compute_similarity_matrix, NeighborIndex) use --dense-max rows
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from benchmarks.corpus import parse_size, make_songs, write_raw_csvs, make_embeddings, StubModel
+from src.ingest import ingest_raw_data
+from src.text_processing import load_songs, clean_lyrics, clean_lyrics_batch, split_into_sentences, split_into_sentences_batch
+from src.embeddings import generate_embeddings
+from src.search_index import SongSearchIndex
+from src.similarity import compute_similarity_matrix, find_most_similar, get_top_phrase_pairs, NeighborIndex
+from src.store import quantize_embeddings
+from src.heatmap import pool_heatmap
+
+def measure(fn, repeat: int, memory: bool) -> tuple[float, float | None]:
+    #fn() is called repeat times for the time (min), once more under tracemalloc for the peak
+    fn() #warm up: caches, lazy imports, page faults
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return best, peak
+
+def text_cases(n_songs: int, workdir: str, dim: int) -> list[tuple]:
+    songs = make_songs(n_songs)
+    lyrics = songs["Lyric"].tolist()
+    cleaned = clean_lyrics_batch(lyrics).tolist()
+    raw_dir = write_raw_csvs(songs, os.path.join(workdir, "raw"))
+    cache_dir = os.path.join(workdir, "cache")
+    ingest_raw_data(str(raw_dir), cache_dir)
+
+    def ingest():
+        ingest_raw_data(str(raw_dir), cache_dir, force=True)
+
+    model = StubModel(dim)
+    lines, _ = split_into_sentences_batch(cleaned)
+    lines = lines[:50_000].tolist()
+    search_index = SongSearchIndex.from_df(songs)
+    queries = ["s", "lo", "love", "song 1", "artist 00"]
+
+    def search():
+        for query in queries:
+            search_index.search(query, limit=100)
+
+    #(name, fn, items processed, unit)
+    return [
+        ("ingest_raw_data", ingest, n_songs, "songs"),
+        ("load_songs", lambda: load_songs(cache_dir), n_songs, "songs"),
+        ("clean_lyrics", lambda: [clean_lyrics(t) for t in lyrics], n_songs, "songs"),
+        ("clean_lyrics_batch", lambda: clean_lyrics_batch(lyrics), n_songs, "songs"),
+        ("split_into_sentences", lambda: [split_into_sentences(t) for t in cleaned], n_songs, "songs"),
+        ("split_into_sentences_batch", lambda: split_into_sentences_batch(cleaned), n_songs, "songs"),
+        ("search_index", search, len(queries), "queries"),
+        ("encode_stub", lambda: generate_embeddings(lines, model, show_progress=False), len(lines), "lines"),
+    ]
+
+def vector_cases(n_rows: int, dim: int, dense_max: int) -> list[tuple]:
+    embeddings = make_embeddings(n_rows, dim)
+    dense_rows = min(n_rows, dense_max)
+    dense = embeddings[:dense_rows]
+    sim_matrix = compute_similarity_matrix(dense, normalized=True)
+    neighbors = NeighborIndex.build(dense, k=50)
+    store = quantize_embeddings(embeddings, "int8")
+    queries = np.random.default_rng(1).integers(0, dense_rows, size=200)
+    store_queries = queries[:20]
+    phrase_small = np.random.default_rng(2).random((40, 40), dtype=np.float32)
+    phrase_big = np.random.default_rng(3).random((2000, 2000), dtype=np.float32)
+    phrases = [f"line {i}" for i in range(2000)]
+
+    def similar_dense():
+        for q in queries:
+            find_most_similar(int(q), sim_matrix, n=10)
+
+    def similar_index():
+        for q in queries:
+            find_most_similar(int(q), neighbors, n=10)
+
+    def similar_int8():
+        for q in store_queries:
+            find_most_similar(int(q), store, n=10)
+
+    def phrase_pairs_small():
+        for _ in range(200):
+            get_top_phrase_pairs(phrase_small, phrases, phrases, n=5)
+
+    return [
+        ("compute_similarity_matrix", lambda: compute_similarity_matrix(dense, normalized=True), dense_rows ** 2, "pairs"),
+        ("neighbor_index_build", lambda: NeighborIndex.build(dense, k=50), dense_rows, "songs"),
+        ("find_most_similar_dense", similar_dense, len(queries), "queries"),
+        ("find_most_similar_index", similar_index, len(queries), "queries"),
+        ("find_most_similar_int8_scan", similar_int8, len(store_queries) * n_rows, "rows"),
+        ("get_top_phrase_pairs_40x40", phrase_pairs_small, 200, "matrices"),
+        ("get_top_phrase_pairs_2000x2000", lambda: get_top_phrase_pairs(phrase_big, phrases, phrases, n=5), phrase_big.size, "cells"),
+        ("pool_heatmap_2000x2000", lambda: pool_heatmap(phrase_big), phrase_big.size, "cells"),
+    ]
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    #a case regresses if its throughput fell more than tolerance below the baseline's
+    old = {(r["name"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\n{'case':34} {'size':>9} {'baseline':>14} {'now':>14} {'ratio':>7}")
+    for r in results:
+        ref = old.get((r["name"], r["size"]))
+        if ref is None:
+            continue
+        ratio = r["throughput"] / ref["throughput"]
+        flag = " <-- slower" if ratio < 1 - tolerance else ""
+        print(f"{r['name']:34} {r['size']:>9,} {ref['throughput']:>14,.0f} {r['throughput']:>14,.0f} {ratio:>6.2f}x{flag}")
+        if flag:
+            regressions.append(f"{r['name']} @ {r['size']}: {ratio:.2f}x of baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["10k", "100k", "1m"])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--text-max", type=parse_size, default=parse_size("100k"), help="max songs for the text cases")
+    parser.add_argument("--dense-max", type=parse_size, default=4000, help="max rows for the N x N cases")
+    parser.add_argument("--only", nargs="+", help="run only cases whose name starts with one of these")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass (it is slow on python-heavy cases)")
+    parser.add_argument("--out", default="benchmarks/results.json")
+    parser.add_argument("--baseline", help="json from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop vs the baseline")
+    args = parser.parse_args()
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="textwise-bench-")
+    try:
+        for size in map(parse_size, args.sizes):
+            n_songs = min(size, args.text_max)
+            print(f"\n== {size:,} rows (text cases on {n_songs:,} songs) ==")
+            start = time.perf_counter()
+            cases = text_cases(n_songs, os.path.join(workdir, str(size)), args.dim) + vector_cases(size, args.dim, args.dense_max)
+            print(f"corpus ready in {time.perf_counter() - start:.1f} s")
+
+            for name, fn, items, unit in cases:
+                if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                    continue
+                seconds, peak = measure(fn, args.repeat, not args.no_memory)
+                results.append({
+                    "name": name,
+                    "size": size,
+                    "items": items,
+                    "unit": unit,
+                    "seconds": seconds,
+                    "throughput": items / seconds,
+                    "peak_mb": peak
+                })
+                memory = f"{peak:9.1f} MB" if peak is not None else ""
+                print(f"{name:34} {seconds * 1000:10.2f} ms {items / seconds:14,.0f} {unit}/s {memory}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump({"environment": environment(), "args": vars(args), "results": results}, f, indent=1)
+    print(f"\nresults saved in: {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nregressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
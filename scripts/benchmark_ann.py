@@ -0,0 +1,71 @@
+'''
+recall@k and latency of the IVF index against exact search, for several nprobe values
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import time
+from pathlib import Path
+import numpy as np
+
+from src.similarity import IVFIndex
+from src.artifacts import artifact_dir, EMBEDDINGS_FILE
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", default=str(artifact_dir() / EMBEDDINGS_FILE))
+    parser.add_argument("--synthetic", type=int, default=0, help="use N random embeddings instead of the file")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--save", action="store_true", help="save the index to embeddings/ivf")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        #clustered fake data, uniform noise has no neighbors worth finding
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((max(1, args.synthetic // 100), args.dim))
+        embeddings = centers[rng.integers(0, len(centers), args.synthetic)]
+        embeddings = (embeddings + 0.5 * rng.standard_normal(embeddings.shape)).astype(np.float32)
+    else:
+        embeddings = np.load(args.embeddings)
+    n_songs = len(embeddings)
+
+    start = time.perf_counter()
+    ivf = IVFIndex.build(embeddings, n_lists=args.n_lists)
+    print(f"{n_songs} songs, {ivf.n_lists} lists, built in {time.perf_counter() - start:.2f} s")
+    if args.save:
+        ivf.save(str(Path(args.embeddings).parent / "ivf"))
+
+    queries = np.random.default_rng(1).choice(n_songs, size=min(args.queries, n_songs), replace=False)
+
+    #ground truth by brute force, only for the query rows
+    normed = ivf.list_vectors[ivf.positions]
+    truth = {}
+    start = time.perf_counter()
+    for song_idx in queries:
+        scores = normed @ normed[song_idx]
+        scores[song_idx] = -np.inf
+        truth[song_idx] = set(np.argsort(-scores)[:args.k].tolist())
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"{'exact':>10} | recall@{args.k} 1.000 | {exact_ms:7.3f} ms/query")
+
+    for nprobe in args.nprobe:
+        if nprobe > ivf.n_lists:
+            break
+        hits = 0
+        latencies = []
+        for song_idx in queries:
+            start = time.perf_counter()
+            found = ivf.query(int(song_idx), n=args.k, nprobe=nprobe)
+            latencies.append(time.perf_counter() - start)
+            hits += len(truth[song_idx] & {idx for idx, _ in found})
+        recall = hits / (len(queries) * args.k)
+        print(f"nprobe {nprobe:>3} | recall@{args.k} {recall:.3f} | "
+              f"{np.mean(latencies) * 1000:7.3f} ms/query (p95 {np.percentile(latencies, 95) * 1000:.3f})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+'''
+torch vs onnx vs onnx-int8: cosine of every embedding against the torch one
+(parity), throughput on lyric lines and single-query latency
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import time
+import numpy as np
+
+from src.embeddings import DEFAULT_MODEL, load_model
+from src.encoders import onnx_exists
+from src.ingest import ingest_raw_data, load_song_cache
+from src.text_processing import split_into_sentences_batch
+
+def normalized(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--texts", type=int, default=2000, help="lyric lines to encode")
+    parser.add_argument("--queries", type=int, default=200, help="single-text encodes for latency")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="parity threshold against torch")
+    args = parser.parse_args()
+
+    ingest_raw_data("data/raw_data", "data/cache/songs")
+    lyrics = load_song_cache("data/cache/songs", ["clean_lyric"])["clean_lyric"].tolist()
+    lines, _ = split_into_sentences_batch(lyrics)
+    texts = lines[:args.texts].tolist()
+    print(f"{len(texts)} lines, batch size {args.batch_size}")
+
+    backends = ["torch"] + [b for b, q in (("onnx", False), ("onnx-int8", True)) if onnx_exists(args.model, quantized=q)]
+    if len(backends) == 1:
+        print("no exported onnx model, run scripts/export_onnx.py to compare")
+
+    reference = None
+    failed = False
+    for backend in backends:
+        model = load_model(args.model, backend=backend)
+        model.encode(texts[:args.batch_size], batch_size=args.batch_size) #warm up
+
+        start = time.perf_counter()
+        embeddings = normalized(model.encode(texts, batch_size=args.batch_size))
+        elapsed = time.perf_counter() - start
+
+        latencies = []
+        for text in texts[:args.queries]:
+            start = time.perf_counter()
+            model.encode([text], batch_size=1)
+            latencies.append((time.perf_counter() - start) * 1000)
+        p50, p95 = np.percentile(latencies, [50, 95])
+
+        parity = ""
+        if reference is None:
+            reference = embeddings
+        else:
+            cosines = (embeddings * reference).sum(axis=1)
+            parity = f" | cosine vs torch min {cosines.min():.4f} mean {cosines.mean():.4f}"
+            failed |= cosines.min() < args.min_cosine
+
+        print(f"{backend:10} {len(texts) / elapsed:8,.0f} texts/s | 1 query p50 {p50:6.2f} ms p95 {p95:6.2f} ms{parity}")
+
+    if failed:
+        print(f"some backend is under cosine {args.min_cosine}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
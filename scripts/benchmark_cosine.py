@@ -0,0 +1,52 @@
+'''
+sklearn cosine_similarity vs the BLAS dot fast path: raw embeddings,
+pre-normalized ones, and pre-normalized + a reused out= buffer
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import time
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from src.similarity import compute_similarity_matrix, cosine_scores, l2_normalize
+
+def best_time(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[30, 100, 1000, 5000], help="rows (30 ~ lines of one song)")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>6} | {'sklearn':>10} {'dot':>10} {'normalized':>11} {'+ out=':>10} | x vs sklearn")
+    for n in args.sizes:
+        x = rng.standard_normal((n, args.dim), dtype=np.float32)
+        y = rng.standard_normal((n + 7, args.dim), dtype=np.float32)
+        x_norm, y_norm = l2_normalize(x), l2_normalize(y)
+        buffer = np.empty((n, n + 7), dtype=np.float32)
+
+        expected = cosine_similarity(x, y)
+        assert np.allclose(cosine_scores(x, y), expected, atol=1e-5)
+        assert np.allclose(cosine_scores(x_norm, y_norm, normalized=True, out=buffer), expected, atol=1e-5)
+        assert np.allclose(compute_similarity_matrix(x), cosine_similarity(x), atol=1e-5)
+
+        repeat = max(3, args.repeat * 1000 // max(n, 1000))
+        slow = best_time(lambda: cosine_similarity(x, y), repeat)
+        dot = best_time(lambda: cosine_scores(x, y), repeat)
+        prenorm = best_time(lambda: cosine_scores(x_norm, y_norm, normalized=True), repeat)
+        reused = best_time(lambda: cosine_scores(x_norm, y_norm, normalized=True, out=buffer), repeat)
+        print(f"{n:>6} | {slow * 1000:>8.3f}ms {dot * 1000:>8.3f}ms {prenorm * 1000:>9.3f}ms {reused * 1000:>8.3f}ms | "
+              f"x{slow / dot:.1f} / x{slow / prenorm:.1f} / x{slow / reused:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+'''
+compare the dense N x N similarity matrix against the top-k neighbor index
+memory + build time + query latency
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import time
+import numpy as np
+
+from src.similarity import compute_similarity_matrix, find_most_similar, NeighborIndex
+from src.artifacts import artifact_dir, EMBEDDINGS_FILE
+
+def load_or_fake_embeddings(path: str, n_songs: int, dim: int) -> np.ndarray:
+    if n_songs:
+        rng = np.random.default_rng(0)
+        return rng.standard_normal((n_songs, dim)).astype(np.float32)
+    return np.load(path)
+
+def time_queries(similarity, n_songs: int, n_queries: int, n: int) -> np.ndarray:
+    rng = np.random.default_rng(1)
+    latencies = []
+    for song_idx in rng.integers(0, n_songs, size=n_queries):
+        start = time.perf_counter()
+        find_most_similar(int(song_idx), similarity, n=n)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000
+
+def report(name: str, build_s: float, nbytes: int, latencies_ms: np.ndarray):
+    print(f"{name:>8} | build {build_s:7.2f} s | memory {nbytes / 1e6:9.1f} MB | "
+          f"query p50 {np.percentile(latencies_ms, 50):7.3f} ms  p95 {np.percentile(latencies_ms, 95):7.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", default=str(artifact_dir() / EMBEDDINGS_FILE))
+    parser.add_argument("--synthetic", type=int, default=0, help="use N random embeddings instead of the file")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--skip-dense", action="store_true", help="dense matrix won't fit for big N")
+    args = parser.parse_args()
+
+    embeddings = load_or_fake_embeddings(args.embeddings, args.synthetic, args.dim)
+    n_songs = len(embeddings)
+    print(f"{n_songs} songs, dim {embeddings.shape[1]}, k={args.k}")
+
+    start = time.perf_counter()
+    index = NeighborIndex.build(embeddings, k=args.k)
+    index_build = time.perf_counter() - start
+    report("index", index_build, index.nbytes, time_queries(index, n_songs, args.queries, 10))
+
+    if args.skip_dense:
+        return
+
+    start = time.perf_counter()
+    dense = compute_similarity_matrix(embeddings)
+    dense_build = time.perf_counter() - start
+    report("dense", dense_build, dense.nbytes, time_queries(dense, n_songs, args.queries, 10))
+
+    #both should agree on the neighbors
+    rng = np.random.default_rng(2)
+    mismatches = 0
+    for song_idx in rng.integers(0, n_songs, size=min(args.queries, n_songs)):
+        a = [idx for idx, _ in find_most_similar(int(song_idx), dense, n=10)]
+        b = [idx for idx, _ in find_most_similar(int(song_idx), index, n=10)]
+        mismatches += a != b
+    print(f"queries with different top-10: {mismatches}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''
+latency of free-text semantic search on a synthetic catalogue, with a stub
+encoder so it runs offline. exits with 1 if p95 goes over the budget
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.corpus import StubModel
+from src.similarity import encode_query, semantic_search, IVFIndex
+from src.phrase_cache import PhraseEmbeddingCache
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--songs", type=int, default=100_000)
+    parser.add_argument("--lines", type=int, default=200_000, help="total precomputed lines (0 to skip)")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--distinct", type=int, default=100, help="distinct query strings, the rest are repeats")
+    parser.add_argument("--encode-ms", type=float, default=8.0, help="simulated model cost per query")
+    parser.add_argument("--ivf", action="store_true", help="search songs and lines through IVF indexes, like a version built with --ivf")
+    parser.add_argument("--nprobe", type=int, default=8, help="the app and the service use IVFIndex.load's default, 8")
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="p95 budget")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    #stored normalized like generate_embeddings.py writes them (manifest normalized=True)
+    embeddings = rng.standard_normal((args.songs, args.dim), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    line_embeddings = line_offsets = None
+    if args.lines:
+        line_embeddings = rng.standard_normal((args.lines, args.dim), dtype=np.float32)
+        line_embeddings /= np.linalg.norm(line_embeddings, axis=1, keepdims=True)
+        cuts = np.sort(rng.integers(0, args.lines, size=args.songs - 1))
+        line_offsets = np.r_[0, cuts, args.lines].astype(np.int64)
+
+    song_rows, line_rows = embeddings, line_embeddings
+    ivf_dir = tempfile.TemporaryDirectory(prefix="textwise-ivf-")
+    if args.ivf:
+        #same build as generate_embeddings.py and the same mmap load as the app/service
+        start = time.perf_counter()
+        IVFIndex.build(embeddings).save(f"{ivf_dir.name}/ivf")
+        song_rows = IVFIndex.load(f"{ivf_dir.name}/ivf", nprobe=args.nprobe)
+        if args.lines:
+            IVFIndex.build(line_embeddings).save(f"{ivf_dir.name}/ivf/lines")
+            line_rows = IVFIndex.load(f"{ivf_dir.name}/ivf/lines", nprobe=args.nprobe)
+        print(f"ivf indexes built in {time.perf_counter() - start:.1f} s")
+
+    model = StubModel(args.dim, cost_ms=args.encode_ms) #queries are encoded one at a time, cost_ms is per query
+    cache = PhraseEmbeddingCache("stub", cache_dir=None, max_memory_items=10_000)
+    queries = [f"query about theme {i % args.distinct}" for i in range(args.queries)]
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        query_vec = encode_query(query, model, cache=cache)
+        semantic_search(query_vec, song_rows, n=10, normalized=True,
+                        line_embeddings=line_rows, line_offsets=line_offsets, n_lines=5)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.array(latencies)
+    ivf_dir.cleanup()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{args.songs:,} songs, {args.lines:,} lines, dim {args.dim}, {'ivf' if args.ivf else 'brute force'}, {args.queries} queries "
+          f"({cache.hits} cache hits / {cache.misses} misses)")
+    print(f"p50 {p50:.2f} ms | p95 {p95:.2f} ms | p99 {p99:.2f} ms | budget p95 < {args.budget_ms} ms")
+
+    if p95 > args.budget_ms:
+        print("over budget")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+'''
+import time and memory of the read-only serving path (load songs + neighbors +
+similarity), each case in a fresh interpreter. fails if torch / sentence_transformers
+got imported on the way, that path has to work without them installed
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import json
+import subprocess
+
+HEAVY = ["torch", "sentence_transformers", "transformers", "sklearn", "scipy"]
+MUST_NOT_LOAD = {"torch", "sentence_transformers", "transformers"}
+
+CASES = {
+    "import src": "import src",
+    "from src import load_songs": "from src import load_songs",
+    "serving path": (
+        "from src import load_songs, NeighborIndex, find_most_similar, show_embeddings, artifact_dir\n"
+        "import os\n"
+        "if os.path.isdir('data/cache/songs'):\n"
+        "    load_songs('data/cache/songs', columns=['display_title'])\n"
+        "neighbors = str(artifact_dir() / 'neighbors')\n"
+        "if NeighborIndex.exists(neighbors):\n"
+        "    find_most_similar(0, NeighborIndex.load(neighbors), n=10)\n"
+    ),
+    "import src.service": "import src.service",
+}
+
+PROBE = '''
+import sys, time, resource, json
+start = time.perf_counter()
+exec({code!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+'''
+
+def run_case(code: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", "import sys; sys.path.insert(0, '.')\n" + PROBE.format(code=code, heavy=HEAVY)],
+        capture_output=True, text=True
+    )
+    if out.returncode != 0:
+        return {"error": out.stderr.strip().splitlines()[-1]}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest one is reported")
+    args = parser.parse_args()
+
+    failed = False
+    for name, code in CASES.items():
+        runs = [run_case(code) for _ in range(args.repeat)]
+        errors = [r for r in runs if "error" in r]
+        if errors:
+            print(f"{name:28} error: {errors[0]['error']}")
+            failed = True
+            continue
+        best = min(runs, key=lambda r: r["seconds"])
+        heavy = ", ".join(best["heavy"]) or "-"
+        print(f"{name:28} {best['seconds'] * 1000:8.1f} ms | max rss {best['max_rss_mb']:6.1f} MB | heavy modules: {heavy}")
+        if MUST_NOT_LOAD & set(best["heavy"]):
+            failed = True
+
+    if failed:
+        print("the serving path imported the model stack (or broke)")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
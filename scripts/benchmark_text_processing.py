@@ -0,0 +1,51 @@
+'''
+checks that the batch versions of clean_lyrics / split_into_sentences give
+exactly the same output as the per-song ones, and compares their throughput
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import time
+
+from src.text_processing import clean_lyrics, clean_lyrics_batch, split_into_sentences, split_into_sentences_batch
+from src.ingest import ingest_raw_data, load_song_cache
+
+#weird inputs the corpus might not have
+EDGE_CASES = [
+    None, "", 3.0, "   ", "[Chorus]", "a\n\n  b\nccc dd. e, ffffff",
+    "one line here\nline two is here\nline three is here\nfour is here too",
+    "x]  \n\n  [", "tab\tand nbsp, ok. sí señor 😀"
+]
+
+def timed(fn, *args) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=1, help="repeat the corpus N times to make it bigger")
+    args = parser.parse_args()
+
+    ingest_raw_data("data/raw_data", "data/cache/songs")
+    texts = load_song_cache("data/cache/songs", ["Lyric"])["Lyric"].tolist() * args.repeat + EDGE_CASES
+    n_chars = sum(len(t) for t in texts if isinstance(t, str))
+    print(f"{len(texts)} lyrics, {n_chars / 1e6:.1f}M chars")
+
+    slow, expected = timed(lambda: [clean_lyrics(t) for t in texts])
+    fast, got = timed(clean_lyrics_batch, texts)
+    assert got.tolist() == expected, "clean_lyrics_batch differs from clean_lyrics"
+    print(f"clean_lyrics          {slow:6.2f} s | batch {fast:6.2f} s | x{slow / fast:.1f}")
+
+    slow, expected = timed(lambda: [split_into_sentences(t) for t in texts])
+    fast, (lines, offsets) = timed(split_into_sentences_batch, texts)
+    got = [lines[a:b].tolist() for a, b in zip(offsets[:-1], offsets[1:])]
+    assert got == expected, "split_into_sentences_batch differs from split_into_sentences"
+    print(f"split_into_sentences  {slow:6.2f} s | batch {fast:6.2f} s | x{slow / fast:.1f} "
+          f"({len(lines)} lines, {len(lines) / fast:,.0f} lines/s)")
+
+    print("outputs match")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+'''
+full argsort vs top_k (argpartition + sort of the k best) for a single row
+and for batches of rows, across catalogue sizes and k
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import time
+import numpy as np
+
+from src.similarity import top_k
+
+def best_time(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--ks", type=int, nargs="+", default=[5, 50, 500])
+    parser.add_argument("--batch", type=int, default=64, help="rows per batch for the 2-D case")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'N':>10} {'k':>5} | {'argsort':>10} {'top_k':>10} {'x':>6} | {'batch argsort':>14} {'batch top_k':>12} {'x':>6}")
+    for n in args.sizes:
+        row = rng.standard_normal(n, dtype=np.float32)
+        rows = rng.standard_normal((max(1, min(args.batch, 10_000_000 // n)), n), dtype=np.float32)
+        for k in args.ks:
+            if k > n:
+                continue
+            expected = np.argsort(-row, kind="stable")[:k]
+            assert np.array_equal(np.sort(row[top_k(row, k).indices]), np.sort(row[expected])), "top_k differs from argsort"
+
+            slow = best_time(lambda: np.argsort(row)[::-1][:k], args.repeat)
+            fast = best_time(lambda: top_k(row, k), args.repeat)
+            batch_slow = best_time(lambda: np.argsort(-rows, axis=1)[:, :k], args.repeat)
+            batch_fast = best_time(lambda: top_k(rows, k), args.repeat)
+            print(f"{n:>10,} {k:>5} | {slow * 1000:>8.2f}ms {fast * 1000:>8.2f}ms {slow / fast:>5.1f}x | "
+                  f"{batch_slow * 1000:>12.2f}ms {batch_fast * 1000:>10.2f}ms {batch_slow / batch_fast:>5.1f}x "
+                  f"({len(rows)} rows)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+'''
+one-off: export the sentence-transformers model to onnx (+ int8) so serving can use
+load_model(backend="onnx" / "onnx-int8") without torch. needs torch, onnx and onnxruntime
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+
+from src.embeddings import DEFAULT_MODEL
+from src.encoders import export_onnx, ONNX_DIR
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--output", default=ONNX_DIR)
+    parser.add_argument("--no-int8", action="store_true", help="skip the quantized copy")
+    args = parser.parse_args()
+
+    export_onnx(args.model, args.output, quantize=not args.no_int8)
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,196 @@
 import sys
 sys.path.insert(0, ".")
 
-from src.text_processing import load_songs, clean_lyrics
-from src.embeddings import generate_save_embeddings
+import argparse
+import numpy as np
+
+from src.text_processing import load_songs
+from src.ingest import ingest_raw_data
+from src.embeddings import (
+    DEFAULT_MODEL,
+    load_model,
+    generate_save_embeddings,
+    update_embeddings,
+    generate_embeddings_sharded,
+    save_manifest,
+    content_hash,
+    load_manifest,
+    match_rows,
+    show_embeddings,
+    generate_line_embeddings,
+    save_line_embeddings,
+    load_line_embeddings,
+    line_embeddings_exist
+)
+from src.similarity import NeighborIndex, IVFIndex, ArtistIndex
+from src.store import quantize_embeddings, save_embedding_store, embedding_store_exists
+from src.artifacts import ARTIFACT_ROOT, EMBEDDINGS_FILE, new_version_dir, artifact_dir, set_current, prune_versions
+
+def update_artist_index(previous_dir, embeddings, artists: list[str], song_keys: list[str], lyrics: list[str], pooling: str | None = None):
+    '''
+    the previous version's artist sums, minus the rows that are gone or changed, plus
+    the new/changed ones: costs the changed songs, not the catalogue.
+    None if there's nothing usable to start from (then it's built from scratch)
+    '''
+    previous = previous_dir / EMBEDDINGS_FILE
+    manifest = load_manifest(str(previous))
+    if manifest is None or not ArtistIndex.exists(previous_dir / "artists"):
+        return None
+    if manifest["model_name"] != DEFAULT_MODEL or manifest.get("pooling") != pooling:
+        return None #update_embeddings re-embedded everything, the old vectors don't match
+    index = ArtistIndex.load(previous_dir / "artists")
+    if index.rows is None or len(index.rows) != manifest["n_rows"]:
+        return None
+
+    new_idx, old_idx, todo = match_rows(manifest, song_keys, [content_hash(l) for l in lyrics])
+    gone = np.setdiff1d(np.arange(manifest["n_rows"]), old_idx)
+    if len(gone):
+        old_embeddings = show_embeddings(str(previous), mmap=True)
+        index.remove(old_embeddings[gone], [index.names[code] for code in index.rows[gone]])
+    if todo:
+        index.add(embeddings[todo], [artists[i] for i in todo])
+    index.rows = np.array([index.position(a) for a in artists], dtype=np.int32)
+    print(f"artist centroids: -{len(gone)} +{len(todo)} songs")
+    return index
+
+def _ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    #every index of [starts[i], starts[i] + lengths[i]) in one array
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return shift + np.arange(int(lengths.sum()))
+
+def update_line_embeddings(previous_dir, lyrics: list[str], song_keys: list[str], get_model):
+    '''
+    line rows of the unchanged songs are taken from the previous version through its
+    offsets, only the new/changed songs are split and encoded.
+    None if there's nothing usable to start from
+    '''
+    manifest = load_manifest(str(previous_dir / EMBEDDINGS_FILE))
+    if manifest is None or not line_embeddings_exist(previous_dir / "lines"):
+        return None
+    if manifest["model_name"] != DEFAULT_MODEL:
+        return None
+    old_embeddings, old_offsets = load_line_embeddings(str(previous_dir / "lines"), mmap=True)
+    if len(old_offsets) != manifest["n_rows"] + 1:
+        return None
+
+    new_idx, old_idx, todo = match_rows(manifest, song_keys, [content_hash(l) for l in lyrics])
+    new_idx, old_idx = np.array(new_idx, dtype=np.int64), np.array(old_idx, dtype=np.int64)
+    todo_embeddings, todo_offsets = generate_line_embeddings([lyrics[i] for i in todo], get_model()) if todo else (None, None)
+
+    counts = np.zeros(len(lyrics), dtype=np.int64)
+    counts[new_idx] = np.diff(old_offsets)[old_idx]
+    if todo:
+        counts[todo] = np.diff(todo_offsets)
+    offsets = np.zeros(len(lyrics) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    embeddings = np.empty((offsets[-1], old_embeddings.shape[1]), dtype=np.float32)
+    lengths = counts[new_idx]
+    embeddings[_ranges(offsets[new_idx], lengths)] = old_embeddings[_ranges(old_offsets[old_idx], lengths)]
+    if todo:
+        todo = np.array(todo, dtype=np.int64)
+        embeddings[_ranges(offsets[todo], counts[todo])] = todo_embeddings
+    print(f"line embeddings: {len(new_idx)} songs kept, {len(todo)} encoded")
+    return embeddings, offsets
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ivf", action="store_true", help="also build the approximate (IVF) indexes, for songs and lines")
+    parser.add_argument("--incremental", action="store_true", help="only embed new or changed songs")
+    parser.add_argument("--quantize", choices=["int8", "float16"], help="also save a compact copy of the embeddings")
+    parser.add_argument("--chunked", choices=["mean", "attention"], help="embed long lyrics in windows and pool them")
+    parser.add_argument("--workers", type=int, default=0, help="encode in N processes, resumable if it crashes")
+    parser.add_argument("--shard-size", type=int, default=512)
+    parser.add_argument("--lines", action="store_true", help="also embed every line of every song (step 3 without the model)")
+    parser.add_argument("--keep-versions", type=int, default=3, help="older artifact versions to keep on disk")
+    args = parser.parse_args()
+    if args.workers and args.chunked:
+        parser.error("--chunked doesn't work with --workers yet")
+    
     print("loading songies")
-    df = load_songs("data/songs.csv")
+    ingest_raw_data("data/raw_data", "data/cache/songs")
+    df = load_songs("data/cache/songs", columns=["Artist", "song_key", "clean_lyric"])
     print(f"total of: {len(df)} songies")
     
-    print("cleaning...")
-    lyrics = [clean_lyrics(lyric) for lyric in df["Lyric"].tolist()]
+    lyrics = df["clean_lyric"].tolist() #already cleaned at ingest time
+    
+    song_keys = df["song_key"].tolist()
+    
+    #everything goes to a new version folder, CURRENT only moves once it is all written
+    previous_dir = artifact_dir(ARTIFACT_ROOT)
+    previous = previous_dir / EMBEDDINGS_FILE
+    version = new_version_dir(ARTIFACT_ROOT)
+    output_path = str(version / EMBEDDINGS_FILE)
+    print(f"writing version {version.name}")
+    
+    if args.incremental:
+        model = None
+        embeddings = update_embeddings(
+            lyrics=lyrics,
+            song_keys=song_keys,
+            output_path=output_path,
+            pooling=args.chunked,
+            base_path=str(previous)
+        )
+    elif args.workers:
+        model = None
+        embeddings = generate_embeddings_sharded(
+            lyrics,
+            output_path=output_path,
+            shard_size=args.shard_size,
+            n_workers=args.workers,
+            shard_dir=f"{ARTIFACT_ROOT}/song_embeddings.shards" #same place every run so a crashed one can resume
+        )
+        save_manifest(output_path, DEFAULT_MODEL, song_keys, [content_hash(l) for l in lyrics], normalized=True)
+    else:
+        model = load_model()
+        embeddings = generate_save_embeddings(
+            lyrics=lyrics,
+            output_path=output_path,
+            model=model,
+            song_keys=song_keys,
+            pooling=args.chunked
+        )
+    
+    #whatever the previous version had is rebuilt too, a run without the flags doesn't drop it
+    for dtype in ("int8", "float16"):
+        if args.quantize == dtype or embedding_store_exists(str(previous_dir / f"song_embeddings_{dtype}")):
+            store = quantize_embeddings(embeddings, dtype)
+            save_embedding_store(store, str(version / f"song_embeddings_{dtype}"))
+    
+    def get_model():
+        nonlocal model
+        if model is None:
+            model = load_model()
+        return model
+    
+    lines = None
+    if args.lines or line_embeddings_exist(previous_dir / "lines"):
+        print("embedding lines...")
+        lines = update_line_embeddings(previous_dir, lyrics, song_keys, get_model)
+        if lines is None:
+            lines = generate_line_embeddings(lyrics, get_model())
+        save_line_embeddings(*lines, str(version / "lines"))
+    
+    print("building neighbor index...")
+    index = NeighborIndex.build(embeddings, k=50)
+    index.save(str(version / "neighbors"))
+    
+    artists = df["Artist"].fillna("").astype(str).tolist()
+    artist_index = update_artist_index(previous_dir, embeddings, artists, song_keys, lyrics, args.chunked) if args.incremental else None
+    if artist_index is None:
+        print("building artist centroids...")
+        artist_index = ArtistIndex.build(embeddings, artists)
+    artist_index.save(str(version / "artists"))
+    
+    if args.ivf or IVFIndex.exists(previous_dir / "ivf"):
+        print("building ivf index...")
+        IVFIndex.build(embeddings).save(str(version / "ivf"))
+        if lines is not None and len(lines[0]):
+            IVFIndex.build(lines[0]).save(str(version / "ivf" / "lines"))
     
-    generate_save_embeddings(
-        lyrics=lyrics,
-        output_path="embeddings/song_embeddings.npy"
-    )
+    set_current(version, ARTIFACT_ROOT)
+    prune_versions(ARTIFACT_ROOT, keep=args.keep_versions)
     
     print("\nreaddyyy")
 
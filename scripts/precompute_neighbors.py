@@ -0,0 +1,87 @@
+'''
+batch job: top-k similar songs for the whole catalogue, from the saved embeddings.
+the result is two small arrays (int32 ids, float16 scores by default) that the
+app/service open with NeighborIndex.load (mmap) and read one row per song.
+without --output the live version is never touched: the index goes into a new
+version (other artifacts hard-linked from the one the embeddings came from) and
+CURRENT moves to it, unless another job moved CURRENT in the meantime
+'''
+import sys
+sys.path.insert(0, ".")
+
+import argparse
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+
+from src.embeddings import show_embeddings
+from src.similarity import NeighborIndex
+from src.artifacts import ARTIFACT_ROOT, EMBEDDINGS_FILE, artifact_dir, fork_version, set_current, prune_versions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", help="default: the live version's")
+    parser.add_argument("--output", help="folder for the index, default: a new version of the live artifacts")
+    parser.add_argument("--keep-versions", type=int, default=3, help="older artifact versions to keep on disk")
+    parser.add_argument("-k", type=int, default=50)
+    parser.add_argument("--block-size", type=int, default=1024, help="rows per job")
+    parser.add_argument("--tile-size", type=int, default=8192, help="columns per matmul, 0 for all at once")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="row blocks computed in parallel (threads)")
+    parser.add_argument("--float32", action="store_true", help="keep float32 scores instead of float16")
+    args = parser.parse_args()
+
+    #the new version is forked from the embeddings' own folder, so it is only published
+    #if that folder is still the live one (else we'd roll back whatever replaced it)
+    live = artifact_dir(ARTIFACT_ROOT)
+    if args.embeddings is None:
+        args.embeddings = str(live / EMBEDDINGS_FILE)
+    source = Path(args.embeddings).parent
+    if args.output is None and (Path(args.embeddings).name != EMBEDDINGS_FILE or source.resolve() != live.resolve()):
+        parser.error(f"{args.embeddings} isn't the live version's {EMBEDDINGS_FILE}, pass --output")
+
+    embeddings = show_embeddings(args.embeddings, mmap=True)
+    n_songs, dim = embeddings.shape
+    score_dtype = np.float32 if args.float32 else np.float16
+    tile_size = args.tile_size or None
+    working = args.jobs * args.block_size * (tile_size or n_songs) * 4
+    print(f"{n_songs} songs, dim {dim}, k={args.k}, {args.jobs} jobs, ~{working / 1e6:.0f} MB of scores alive at once")
+
+    start = time.perf_counter()
+    index = NeighborIndex.build(
+        embeddings,
+        k=args.k,
+        block_size=args.block_size,
+        tile_size=tile_size,
+        n_jobs=args.jobs,
+        score_dtype=score_dtype
+    )
+    elapsed = time.perf_counter() - start
+
+    #running apps have the live neighbors/ mmapped, rewriting it in place could hand them a mix
+    version = None
+    if args.output is None:
+        version = fork_version(ARTIFACT_ROOT, replace=("neighbors",), source=source)
+        args.output = str(version / "neighbors")
+    index.save(args.output)
+    if version is not None:
+        if artifact_dir(ARTIFACT_ROOT).resolve() != live.resolve():
+            shutil.rmtree(version)
+            sys.exit(f"CURRENT moved to {artifact_dir(ARTIFACT_ROOT)} while this ran, not switching to an index of {live}")
+        set_current(version, ARTIFACT_ROOT)
+        prune_versions(ARTIFACT_ROOT, keep=args.keep_versions)
+
+    print(f"done in {elapsed:.1f} s: {n_songs / elapsed:,.0f} songs/s, "
+          f"{n_songs * n_songs / elapsed / 1e6:,.0f}M pairs/s, {index.nbytes / 1e6:.1f} MB on disk")
+
+    #reader side: mmap + one row per lookup
+    reader = NeighborIndex.load(args.output, mmap=True)
+    start = time.perf_counter()
+    lookups = np.random.default_rng(0).integers(0, n_songs, size=1000)
+    for song_idx in lookups:
+        reader.neighbors(int(song_idx))
+    print(f"lookup: {(time.perf_counter() - start) / len(lookups) * 1e6:.1f} us per song")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,85 @@
-from .text_processing import (
-    load_songs,
-    clean_lyrics,
-    split_into_sentences,
-    get_song_by_id,
-    search_songs
-)
+'''
+nothing is imported until it's used (PEP 562), so `from src import load_songs`
+only loads text_processing, and torch only comes in with load_model()
+'''
+import importlib
 
-from .embeddings import (
-    load_model,
-    generate_embeddings,
-    save_embeddings,
-    show_embeddings,
-    embedding_exists,
-    generate_save_embeddings
-)
+_EXPORTS = {
+    "load_songs": "text_processing",
+    "clean_lyrics": "text_processing",
+    "clean_lyrics_batch": "text_processing",
+    "split_into_sentences": "text_processing",
+    "split_into_sentences_batch": "text_processing",
+    "get_song_by_id": "text_processing",
+    "make_song_keys": "text_processing",
+    "make_work_ids": "text_processing",
+    "search_songs": "text_processing",
+    "load_model": "embeddings",
+    "generate_embeddings": "embeddings",
+    "generate_chunked_embeddings": "embeddings",
+    "chunk_texts": "embeddings",
+    "pool_segments": "embeddings",
+    "save_embeddings": "embeddings",
+    "show_embeddings": "embeddings",
+    "embedding_exists": "embeddings",
+    "generate_save_embeddings": "embeddings",
+    "generate_embeddings_sharded": "embeddings",
+    "update_embeddings": "embeddings",
+    "generate_line_embeddings": "embeddings",
+    "save_line_embeddings": "embeddings",
+    "load_line_embeddings": "embeddings",
+    "line_embeddings_exist": "embeddings",
+    "OnnxEncoder": "encoders",
+    "export_onnx": "encoders",
+    "compute_similarity_matrix": "similarity",
+    "cosine_scores": "similarity",
+    "l2_normalize": "similarity",
+    "find_most_similar": "similarity",
+    "near_duplicate_groups": "similarity",
+    "top_k": "similarity",
+    "top_k_cells": "similarity",
+    "TopK": "similarity",
+    "quantized_similarities": "similarity",
+    "row_similarities": "similarity",
+    "NeighborIndex": "similarity",
+    "ArtistIndex": "similarity",
+    "most_similar_artists": "similarity",
+    "IVFIndex": "similarity",
+    "calc_phrase_similarity": "similarity",
+    "calc_line_similarity": "similarity",
+    "encode_query": "similarity",
+    "semantic_search": "similarity",
+    "get_top_phrase_pairs": "similarity",
+    "Heatmap": "heatmap",
+    "pool_heatmap": "heatmap",
+    "heatmap_payload": "heatmap",
+    "PhraseEmbeddingCache": "phrase_cache",
+    "QuantizedEmbeddings": "store",
+    "quantize_embeddings": "store",
+    "save_embedding_store": "store",
+    "load_embedding_store": "store",
+    "embedding_store_exists": "store",
+    "ingest_raw_data": "ingest",
+    "cache_is_fresh": "ingest",
+    "load_song_cache": "ingest",
+    "SongSearchIndex": "search_index",
+    "SongCatalog": "catalog",
+    "ArtifactMismatchError": "artifacts",
+    "artifact_dir": "artifacts",
+    "current_version": "artifacts",
+    "set_current": "artifacts",
+    "validate_embeddings": "artifacts",
+}
 
-from .similarity import (
-    compute_similarity_matrix,
-    find_most_similar,
-    calc_phrase_similarity,
-    get_top_phrase_pairs
-)
\ No newline at end of file
+__all__ = list(_EXPORTS)
+
+def __getattr__(name: str):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value #next lookups don't come back here
+    return value
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(_EXPORTS))
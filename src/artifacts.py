@@ -0,0 +1,128 @@
+'''
+versioned embedding artifacts. every run of scripts/generate_embeddings.py writes
+a new folder embeddings/versions/<id>/ (embeddings + manifest, neighbors, lines...)
+and embeddings/CURRENT says which one is live. the pointer is swapped with a
+single os.replace, so a reader sees the old version or the new one, never a mix
+'''
+import hashlib
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+
+ARTIFACT_ROOT = "embeddings"
+EMBEDDINGS_FILE = "song_embeddings.npy"
+
+class ArtifactMismatchError(ValueError):
+    #the embeddings on disk don't belong to the songs / model being used
+    pass
+
+def source_hash(song_keys: list[str], content_hashes: list[str]) -> str:
+    #changes if a song is added, removed, moved to another row or its cleaned lyric changes
+    digest = hashlib.sha1()
+    for key, content in zip(song_keys, content_hashes):
+        digest.update(f"{key}\x1f{content}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def new_version_dir(root: str = ARTIFACT_ROOT) -> Path:
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + os.urandom(3).hex()
+    path = Path(root) / "versions" / version
+    path.mkdir(parents=True)
+    return path
+
+def fork_version(root: str = ARTIFACT_ROOT, replace: tuple[str, ...] = (), source: str | None = None) -> Path:
+    '''
+    new version folder with the files of source (default: the live version) hard-linked in
+    (no copy, files are never rewritten in place) except the entries in replace, which the
+    caller writes. for jobs that rebuild one artifact: write it there, then set_current
+    '''
+    source = artifact_dir(root) if source is None else Path(source)
+    version = new_version_dir(root)
+    for path in source.rglob("*"):
+        relative = path.relative_to(source)
+        if relative.parts[0] in replace or (source == Path(root) and relative.parts[0] in ("versions", "CURRENT")):
+            continue
+        target = version / relative
+        if path.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, target)
+        except OSError: #another filesystem, or no hard links
+            shutil.copy2(path, target)
+    return version
+
+def current_version(root: str = ARTIFACT_ROOT) -> str | None:
+    pointer = Path(root) / "CURRENT"
+    if not pointer.exists():
+        return None
+    return pointer.read_text().strip() or None
+
+def set_current(version_dir: str, root: str = ARTIFACT_ROOT):
+    #readers that already opened the old version keep it (mmaps stay valid), new loads get this one
+    version = Path(version_dir).name
+    if not (Path(root) / "versions" / version / EMBEDDINGS_FILE).exists():
+        raise FileNotFoundError(f"version {version} has no {EMBEDDINGS_FILE}")
+    tmp = Path(root) / "CURRENT.tmp"
+    tmp.write_text(version)
+    os.replace(tmp, Path(root) / "CURRENT")
+    print(f"current embeddings version: {version}")
+
+def artifact_dir(root: str = ARTIFACT_ROOT) -> Path:
+    #folder of the live version, or root itself for the old flat layout (no CURRENT yet)
+    version = current_version(root)
+    if version is None:
+        return Path(root)
+    return Path(root) / "versions" / version
+
+def prune_versions(root: str = ARTIFACT_ROOT, keep: int = 3):
+    #old versions are only deleted here, never the live one
+    versions = sorted(p for p in (Path(root) / "versions").glob("*") if p.is_dir())
+    live = current_version(root)
+    for path in versions[:-keep] if keep else versions:
+        if path.name != live:
+            shutil.rmtree(path)
+
+def validate_embeddings(
+    path: str,
+    embeddings: np.ndarray | None = None,
+    song_keys: list[str] | None = None,
+    lyrics: list[str] | None = None,
+    model_name: str | None = None
+    ) -> dict:
+    '''
+    checks the manifest next to the embeddings against what the caller is about to use
+    and raises ArtifactMismatchError on the first difference. returns the manifest
+    '''
+    from .embeddings import load_manifest, content_hash
+
+    manifest = load_manifest(path)
+    if manifest is None:
+        raise ArtifactMismatchError(f"{path} has no manifest, regenerate it with scripts/generate_embeddings.py")
+
+    if embeddings is not None:
+        if "dim" in manifest and tuple(embeddings.shape) != (manifest["n_rows"], manifest["dim"]):
+            raise ArtifactMismatchError(f"{path} is {tuple(embeddings.shape)}, the manifest says {(manifest['n_rows'], manifest['dim'])}")
+        if "dtype" in manifest and str(embeddings.dtype) != manifest["dtype"]:
+            raise ArtifactMismatchError(f"{path} is {embeddings.dtype}, the manifest says {manifest['dtype']}")
+
+    if model_name is not None and manifest["model_name"] != model_name:
+        raise ArtifactMismatchError(f"{path} was made with {manifest['model_name']}, not {model_name}")
+
+    if song_keys is not None:
+        song_keys = list(song_keys)
+        stored = manifest["song_keys"]
+        if len(stored) != len(song_keys):
+            raise ArtifactMismatchError(f"{path} has {len(stored)} rows but there are {len(song_keys)} songs")
+        if stored != song_keys:
+            row = next(i for i, (a, b) in enumerate(zip(stored, song_keys)) if a != b)
+            raise ArtifactMismatchError(f"{path} row {row} is another song (rows are in a different order or the songs changed)")
+
+    if lyrics is not None and "source_hash" in manifest:
+        keys = song_keys if song_keys is not None else manifest["song_keys"]
+        if source_hash(keys, [content_hash(lyric) for lyric in lyrics]) != manifest["source_hash"]:
+            raise ArtifactMismatchError(f"{path} was made from other lyrics (changed data or cleaning), regenerate it")
+
+    return manifest
@@ -0,0 +1,99 @@
+'''
+what load_songs returns: the songs DataFrame plus hash indices on song_id and
+display_title and numpy arrays per column, so getting one song (or 20) doesn't
+scan the table or build a pandas Series per row
+'''
+import numpy as np
+import pandas as pd
+
+class SongCatalog:
+    '''
+    behaves like the DataFrame it wraps (catalog["Artist"], len(catalog),
+    catalog.iloc...), plus:
+    row_of(song_id) / index_of(display_title) -> row position in O(1),
+    record(row) / records(rows) -> plain dicts straight from the column arrays,
+    group_rows(column) -> {value: rows} for things like "all songs of an artist".
+    indices and arrays are built the first time they're needed and kept
+    '''
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._arrays = {}
+        self._indices = {}
+
+    def __getattr__(self, name: str):
+        #only reached for names SongCatalog doesn't have; "_" names stay out so pickling works
+        if name.startswith("_") or name == "df":
+            raise AttributeError(name)
+        return getattr(self.df, name)
+
+    def __getitem__(self, key):
+        return self.df[key]
+
+    def __setitem__(self, key, value):
+        self.df[key] = value
+        self._arrays.pop(key, None)
+        self._indices = {k: v for k, v in self._indices.items() if k[1] != key}
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def __iter__(self):
+        return iter(self.df)
+
+    def __contains__(self, key) -> bool:
+        return key in self.df
+
+    def __repr__(self) -> str:
+        return f"SongCatalog({len(self.df)} songs, columns={list(self.df.columns)})"
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = self.df[name].to_numpy()
+        return self._arrays[name]
+
+    def _index(self, name: str) -> dict:
+        #value -> first row with it, same as df[df[name] == value].index[0]
+        key = ("index", name)
+        if key not in self._indices:
+            values = self.column(name)
+            self._indices[key] = {value: row for row, value in reversed(list(enumerate(values.tolist())))}
+        return self._indices[key]
+
+    def row_of(self, song_id: int) -> int:
+        ids = self.column("song_id")
+        #load_songs numbers songs 0..N-1, then the row is the id and no dict is needed
+        if 0 <= song_id < len(ids) and ids[song_id] == song_id:
+            return int(song_id)
+        try:
+            return self._index("song_id")[song_id]
+        except KeyError:
+            raise KeyError(f"no song with id {song_id}") from None
+
+    def index_of(self, display_title: str) -> int:
+        try:
+            return self._index("display_title")[display_title]
+        except KeyError:
+            raise KeyError(f"no song called {display_title!r}") from None
+
+    def group_rows(self, name: str) -> dict:
+        #value -> array of rows in table order, one factorize for the whole column
+        key = ("groups", name)
+        if key not in self._indices:
+            codes, uniques = pd.factorize(self.df[name])
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            self._indices[key] = {
+                value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(uniques.tolist())
+            }
+        return self._indices[key]
+
+    def record(self, row: int, columns: list[str] | None = None) -> dict:
+        return {name: self.column(name)[row] for name in columns or self.df.columns}
+
+    def records(self, rows, columns: list[str] | None = None) -> list[dict]:
+        #one fancy-index per column for all rows, then zip into dicts
+        rows = np.asarray(rows, dtype=np.int64)
+        names = list(columns or self.df.columns)
+        values = [self.column(name)[rows].tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
@@ -1,14 +1,45 @@
 '''
 file to generate embeddings using sentence-transformers 
 '''
+from __future__ import annotations
 import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from sentence_transformers import SentenceTransformer #hugging face miniML
+from typing import TYPE_CHECKING
 import pickle 
+from .text_processing import split_into_sentences_batch
+from .artifacts import source_hash
+from .similarity import l2_normalize
+from .metrics import timed, record_encode
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer #hugging face miniML
 
 DEFAULT_MODEL = "all-MiniLM-L6-v2"
 
-def load_model(model_name: str = DEFAULT_MODEL) -> SentenceTransformer:
+def load_model(
+    model_name: str = DEFAULT_MODEL,
+    backend: str = "torch",
+    n_threads: int | None = None
+    ) -> SentenceTransformer:
+    '''
+    backend "torch" is the SentenceTransformer, "onnx" / "onnx-int8" the exported
+    onnx runtime version (scripts/export_onnx.py), same .encode() for the callers
+    '''
+    if backend in ("onnx", "onnx-int8"):
+        from .encoders import OnnxEncoder
+        print(f"loading model {model_name} ({backend})")
+        return OnnxEncoder(model_name, quantized=backend == "onnx-int8", n_threads=n_threads)
+    if backend != "torch":
+        raise ValueError(f"unknown backend: {backend}")
+    
+    #imported here so reading embeddings / similarity never pulls torch in
+    from sentence_transformers import SentenceTransformer
     print(f"loading model {model_name}")
     model = SentenceTransformer(model_name) #should i leave it this way or use -> ('sentence-transformers/all-MiniLM-L6-v2') ?
     return model 
@@ -20,14 +51,103 @@ def generate_embeddings(
     show_progress: bool = True
     ) -> np.ndarray:
     
-    embeddings = model.encode(
-        texts,
-        batch_size=batch_size,
-        show_progress_bar=show_progress,
-        convert_to_numpy=True
-    )
+    record_encode(len(texts))
+    with timed("model_encode"):
+        embeddings = model.encode(
+            texts,
+            batch_size=batch_size,
+            show_progress_bar=show_progress,
+            convert_to_numpy=True
+        )
     return embeddings
 
+def chunk_texts(
+    texts: list[str],
+    model: SentenceTransformer,
+    max_tokens: int | None = None,
+    overlap: int = 32
+    ) -> tuple[list[str], np.ndarray, np.ndarray]:
+    '''
+    the model only sees the first max_seq_length word pieces of a text,
+    so long lyrics get cut into windows that fit (with some overlap).
+    returns all windows, offsets (windows of text i are offsets[i]:offsets[i + 1])
+    and the number of tokens of every window
+    '''
+    if max_tokens is None:
+        max_tokens = model.max_seq_length - 2 #[CLS] and [SEP]
+    overlap = min(overlap, max_tokens // 2)
+    step = max_tokens - overlap
+    
+    #one call for the whole corpus, the fast tokenizer batches it in rust
+    encoded = model.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+    
+    windows, n_tokens, counts = [], [], []
+    for text, spans in zip(texts, encoded["offset_mapping"]):
+        if len(spans) <= max_tokens:
+            windows.append(text)
+            n_tokens.append(max(len(spans), 1))
+            counts.append(1)
+            continue
+        
+        starts = list(range(0, len(spans) - overlap, step))
+        for start in starts:
+            stop = min(start + max_tokens, len(spans))
+            windows.append(text[spans[start][0]:spans[stop - 1][1]])
+            n_tokens.append(stop - start)
+        counts.append(len(starts))
+    
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return windows, offsets, np.asarray(n_tokens, dtype=np.float32)
+
+def pool_segments(
+    embeddings: np.ndarray,
+    offsets: np.ndarray,
+    weights: np.ndarray | None = None,
+    method: str = "mean"
+    ) -> np.ndarray:
+    #one vector per segment (rows offsets[i]:offsets[i + 1]), every segment needs at least one row.
+    #mean: weighted by weights (e.g. tokens per window)
+    #attention: windows closer to the song's mean count more (softmax inside each segment)
+    starts = offsets[:-1]
+    segment = np.repeat(np.arange(len(starts)), np.diff(offsets))
+    if weights is None:
+        weights = np.ones(len(embeddings), dtype=np.float32)
+    
+    mean = np.add.reduceat(embeddings * weights[:, None], starts, axis=0)
+    mean /= np.add.reduceat(weights, starts)[:, None]
+    if method == "mean":
+        return mean
+    if method != "attention":
+        raise ValueError(f"unknown pooling {method}, use 'mean' or 'attention'")
+    
+    normed = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    center = mean / np.maximum(np.linalg.norm(mean, axis=1, keepdims=True), 1e-12)
+    scores = np.einsum("ij,ij->i", normed, center[segment]) / 0.1 #temperature
+    scores = np.exp(scores - np.maximum.reduceat(scores, starts)[segment])
+    scores /= np.add.reduceat(scores, starts)[segment]
+    return np.add.reduceat(embeddings * scores[:, None], starts, axis=0)
+
+def generate_chunked_embeddings(
+    texts: list[str],
+    model: SentenceTransformer,
+    pooling: str = "mean",
+    max_tokens: int | None = None,
+    overlap: int = 32,
+    batch_size: int = 64,
+    show_progress: bool = True
+    ) -> np.ndarray:
+    #all windows of all songs go through one big encode, then get pooled back to one row per song
+    windows, offsets, n_tokens = chunk_texts(texts, model, max_tokens, overlap)
+    print(f"{len(windows)} windows for {len(texts)} texts")
+    embeddings = generate_embeddings(windows, model, batch_size=batch_size, show_progress=show_progress)
+    return pool_segments(embeddings.astype(np.float32), offsets, n_tokens, pooling)
+
+def _encode_texts(texts: list[str], model: SentenceTransformer, pooling: str | None) -> np.ndarray:
+    if pooling is None:
+        return generate_embeddings(texts, model) #anything past max_seq_length is ignored
+    return generate_chunked_embeddings(texts, model, pooling=pooling)
+
 def save_embeddings(embeddings: np.ndarray, path: str):
     path = Path(path)
     path.parent.mkdir(parents=True, exist_ok=True)
@@ -35,27 +155,268 @@ def save_embeddings(embeddings: np.ndarray, path: str):
     
     print(f"embeddings saved in: {path}")
     
-def show_embeddings(path: str) -> np.ndarray:
-    return np.load(path)
+@timed("show_embeddings")
+def show_embeddings(path: str, mmap: bool = False) -> np.ndarray:
+    #mmap=True: read-only pages shared by every process that opens the same file
+    return np.load(path, mmap_mode="r" if mmap else None)
 
 #should i do a funciton to see if an embedding exists?
 def embedding_exists(path:str) -> bool:
     return Path(path).exists()
 
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def manifest_path(path: str) -> Path:
+    path = Path(path)
+    return path.with_name(path.stem + ".manifest.json")
+
+def save_manifest(
+    path: str,
+    model_name: str,
+    song_keys: list[str],
+    hashes: list[str],
+    pooling: str | None = None,
+    normalized: bool = False
+    ):
+    #which song (stable key) and which lyric version lives in each row, plus what the matrix is.
+    #called after the .npy is written, its shape/dtype come from the file header
+    embeddings = np.load(path, mmap_mode="r")
+    manifest = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "n_rows": int(embeddings.shape[0]),
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "dtype": str(embeddings.dtype),
+        "normalized": normalized,
+        "source_hash": source_hash(song_keys, hashes),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "song_keys": list(song_keys),
+        "content_hashes": list(hashes)
+    }
+    del embeddings
+    tmp = manifest_path(path).with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest))
+    os.replace(tmp, manifest_path(path))
+
+def load_manifest(path: str) -> dict | None:
+    path = manifest_path(path)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
 def generate_save_embeddings(lyrics: list[str],
     output_path: str = "embeddings/song_embeddings.npy",
-    model_name: str = DEFAULT_MODEL 
+    model_name: str = DEFAULT_MODEL,
+    model: SentenceTransformer | None = None,
+    song_keys: list[str] | None = None,
+    pooling: str | None = None
     ):
+    #pooling=None: one encode per lyric (truncated), "mean"/"attention": chunk long lyrics and pool
     
-    model = load_model(model_name)
+    if model is None:
+        model = load_model(model_name)
     
     print(f"generating embeddings for {len(lyrics)} songs ! ")
-    embeddings = generate_embeddings(lyrics, model)
+    embeddings = l2_normalize(_encode_texts(lyrics, model, pooling)) #norm 1: cosine is a plain dot product from here on
     
     save_embeddings(embeddings, output_path)
+    if song_keys is not None:
+        save_manifest(output_path, model_name, song_keys, [content_hash(lyric) for lyric in lyrics], pooling, normalized=True)
     
     return embeddings
+
+def match_rows(manifest: dict, song_keys: list[str], hashes: list[str]) -> tuple[list[int], list[int], list[int]]:
+    #(new rows, old rows they can be copied from, new rows that need encoding) against a stored manifest
+    old_rows = {
+        key: (row, h) for row, (key, h) in enumerate(zip(manifest["song_keys"], manifest["content_hashes"]))
+    }
+    new_idx, old_idx, todo = [], [], []
+    for i, (key, h) in enumerate(zip(song_keys, hashes)):
+        row, old_hash = old_rows.get(key, (None, None))
+        if old_hash == h:
+            new_idx.append(i)
+            old_idx.append(row)
+        else:
+            todo.append(i)
+    return new_idx, old_idx, todo
+
+def update_embeddings(lyrics: list[str],
+    song_keys: list[str],
+    output_path: str = "embeddings/song_embeddings.npy",
+    model_name: str = DEFAULT_MODEL,
+    model: SentenceTransformer | None = None,
+    pooling: str | None = None,
+    base_path: str | None = None
+    ) -> np.ndarray:
+    '''
+    incremental version of generate_save_embeddings: only songs that are new
+    or whose cleaned lyric changed get encoded, the rest are copied from the
+    stored matrix. rows end up in the order of song_keys.
+    base_path: read the previous matrix from there instead of output_path (last artifact version)
+    '''
+    base_path = base_path or output_path
+    hashes = [content_hash(lyric) for lyric in lyrics]
+    manifest = load_manifest(base_path)
+    
+    if (manifest is None or not embedding_exists(base_path) or manifest["model_name"] != model_name
+            or manifest.get("pooling") != pooling):
+        print("no usable manifest, embedding everything")
+        return generate_save_embeddings(lyrics, output_path, model_name, model, song_keys, pooling)
+    
+    new_idx, old_idx, todo = match_rows(manifest, song_keys, hashes)
+    
+    print(f"{len(todo)} new or changed songs, reusing {len(new_idx)}")
+    if not todo and old_idx == list(range(len(manifest["song_keys"]))) and Path(base_path) == Path(output_path):
+        return show_embeddings(output_path) #nothing to do
     
+    old_embeddings = np.load(base_path, mmap_mode="r")
+    embeddings = np.empty((len(lyrics), old_embeddings.shape[1]), dtype=old_embeddings.dtype)
+    embeddings[new_idx] = old_embeddings[old_idx]
+    
+    if todo:
+        if model is None:
+            model = load_model(model_name)
+        embeddings[todo] = _encode_texts([lyrics[i] for i in todo], model, pooling)
+    del old_embeddings
+    l2_normalize(embeddings, out=embeddings) #also fixes rows reused from a version saved before normalizing
+    
+    #write next to the old file and swap, a crash never leaves half a matrix
+    tmp = Path(output_path).with_suffix(".tmp.npy")
+    np.save(tmp, embeddings)
+    os.replace(tmp, output_path)
+    save_manifest(output_path, model_name, song_keys, hashes, pooling, normalized=True)
+    
+    print(f"embeddings updated in: {output_path}")
+    return embeddings
 
+_worker_model = None
 
+def _init_worker(model_name: str, n_threads: int, backend: str = "torch"):
+    #runs once per process: every worker loads its own copy of the model
+    global _worker_model
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(n_threads) #otherwise every worker grabs all the cores
+    _worker_model = load_model(model_name, backend=backend, n_threads=n_threads)
 
+def _encode_shard(shard_path: str, texts: list[str], batch_size: int) -> str:
+    embeddings = l2_normalize(generate_embeddings(texts, _worker_model, batch_size=batch_size, show_progress=False))
+    tmp = Path(shard_path).with_suffix(".tmp.npy")
+    np.save(tmp, embeddings)
+    os.replace(tmp, shard_path) #a shard file exists only once it is complete
+    return shard_path
+
+def generate_embeddings_sharded(texts: list[str],
+    output_path: str = "embeddings/song_embeddings.npy",
+    model_name: str = DEFAULT_MODEL,
+    shard_size: int = 512,
+    n_workers: int | None = None,
+    batch_size: int = 64,
+    sort_by_length: bool = True,
+    shard_dir: str | None = None,
+    backend: str = "torch"
+    ) -> np.ndarray:
+    '''
+    same result as generate_save_embeddings but the corpus is cut into shards
+    encoded by a pool of processes. every finished shard is written to
+    shard_dir, so if the run dies the next one skips what was already done.
+    with sort_by_length the shards hold texts of similar length (less padding)
+    '''
+    if not texts:
+        #no shards to read the dim from, the model is loaded just for it
+        dim = load_model(model_name, backend=backend).get_sentence_embedding_dimension()
+        embeddings = np.empty((0, dim), dtype=np.float32)
+        save_embeddings(embeddings, output_path)
+        return embeddings
+    
+    n_workers = n_workers or os.cpu_count() or 1
+    shard_dir = Path(shard_dir) if shard_dir else Path(output_path).with_suffix(".shards")
+    
+    order = np.argsort([len(t) for t in texts], kind="stable") if sort_by_length else np.arange(len(texts))
+    plan = {
+        "model_name": model_name,
+        "backend": backend, #onnx-int8 vectors are a bit off from torch ones, don't mix their shards
+        "n_texts": len(texts),
+        "shard_size": shard_size,
+        "sort_by_length": sort_by_length,
+        "texts_hash": content_hash("\0".join(texts))
+    }
+    
+    #shards from a different corpus/model are useless, start over
+    plan_path = shard_dir / "plan.json"
+    if plan_path.exists() and json.loads(plan_path.read_text()) != plan:
+        print("shards are from another run, starting over")
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    plan_path.write_text(json.dumps(plan))
+    
+    starts = list(range(0, len(texts), shard_size))
+    shard_paths = [shard_dir / f"shard_{i:05d}.npy" for i in range(len(starts))]
+    todo = [i for i, path in enumerate(shard_paths) if not path.exists()]
+    print(f"{len(starts)} shards, {len(starts) - len(todo)} already done, {n_workers} workers")
+    
+    if todo:
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(model_name, n_threads, backend)) as pool:
+            futures = [
+                pool.submit(
+                    _encode_shard,
+                    str(shard_paths[i]),
+                    [texts[j] for j in order[starts[i]:starts[i] + shard_size]],
+                    batch_size
+                )
+                for i in todo
+            ]
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                print(f"shard {done}/{len(todo)} done")
+    
+    #shards are in length order, put every row back where it belongs
+    first = np.load(shard_paths[0])
+    embeddings = np.empty((len(texts), first.shape[1]), dtype=first.dtype)
+    for start, path in zip(starts, shard_paths):
+        shard = np.load(path)
+        embeddings[order[start:start + len(shard)]] = shard
+    
+    save_embeddings(embeddings, output_path)
+    shutil.rmtree(shard_dir)
+    return embeddings
+
+def generate_line_embeddings(
+    lyrics: list[str],
+    model: SentenceTransformer,
+    batch_size: int = 256,
+    show_progress: bool = True
+    ) -> tuple[np.ndarray, np.ndarray]:
+    #every line of every song in one big encode call
+    #lines of song i are rows offsets[i]:offsets[i + 1]
+    all_lines, offsets = split_into_sentences_batch(lyrics)
+    all_lines = all_lines.tolist()
+    
+    print(f"{len(all_lines)} lines from {len(lyrics)} songs")
+    embeddings = generate_embeddings(all_lines, model, batch_size=batch_size, show_progress=show_progress)
+    embeddings = embeddings.astype(np.float32).reshape(len(all_lines), -1)
+    
+    #normalized so comparing lines is just a dot product
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.maximum(norms, 1e-12)
+    return embeddings, offsets
+
+def save_line_embeddings(embeddings: np.ndarray, offsets: np.ndarray, path: str = "embeddings/lines"):
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "line_embeddings.npy", embeddings)
+    np.save(path / "line_offsets.npy", offsets)
+    
+    print(f"line embeddings saved in: {path}")
+
+def load_line_embeddings(path: str = "embeddings/lines", mmap: bool = True) -> tuple[np.ndarray, np.ndarray]:
+    path = Path(path)
+    embeddings = np.load(path / "line_embeddings.npy", mmap_mode="r" if mmap else None)
+    offsets = np.load(path / "line_offsets.npy")
+    return embeddings, offsets
+
+def line_embeddings_exist(path: str = "embeddings/lines") -> bool:
+    path = Path(path)
+    return (path / "line_embeddings.npy").exists() and (path / "line_offsets.npy").exists()
@@ -0,0 +1,140 @@
+'''
+onnx runtime encoder: same .encode() / .tokenizer / .max_seq_length as a
+SentenceTransformer, so everything that takes a model works with it.
+no torch at serving time, only for the one-off export
+'''
+import json
+from pathlib import Path
+import numpy as np
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_DIR = "embeddings/onnx"
+
+def onnx_path(model_name: str, onnx_dir: str = ONNX_DIR) -> Path:
+    return Path(onnx_dir) / model_name.replace("/", "__")
+
+def export_onnx(model_name: str, onnx_dir: str = ONNX_DIR, quantize: bool = True, opset: int = 14) -> Path:
+    '''
+    exports the transformer of a SentenceTransformer to model.onnx (+ model_int8.onnx with
+    dynamic int8 quantization of the weights), next to its tokenizer and an encoder.json
+    with the pooling / normalization the onnx graph doesn't include. needs torch
+    '''
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    out = onnx_path(model_name, onnx_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+
+    pooling = "mean"
+    normalize = False
+    for module in st_model:
+        name = type(module).__name__
+        if name == "Pooling" and module.get_config_dict().get("pooling_mode_cls_token"):
+            pooling = "cls"
+        elif name == "Normalize":
+            normalize = True
+
+    dummy = tokenizer(["hello there"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+    dynamic = {name: {0: "batch", 1: "tokens"} for name in input_names}
+    dynamic["last_hidden_state"] = {0: "batch", 1: "tokens"}
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(dummy[name] for name in input_names),
+            str(out / "model.onnx"),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic,
+            opset_version=opset
+        )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(str(out / "model.onnx"), str(out / "model_int8.onnx"), weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(str(out))
+    config = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "normalize": normalize,
+        "max_seq_length": st_model.max_seq_length,
+        "dim": st_model.get_sentence_embedding_dimension()
+    }
+    (out / "encoder.json").write_text(json.dumps(config, indent=2))
+
+    print(f"onnx model exported in: {out}")
+    return out
+
+def onnx_exists(model_name: str, onnx_dir: str = ONNX_DIR, quantized: bool = False) -> bool:
+    path = onnx_path(model_name, onnx_dir)
+    return (path / "encoder.json").exists() and (path / ("model_int8.onnx" if quantized else "model.onnx")).exists()
+
+
+class OnnxEncoder:
+    '''
+    drop-in for SentenceTransformer.encode on cpu. texts are sorted by length
+    so each batch pads as little as possible, then put back in order
+    '''
+
+    def __init__(self, model_name: str, onnx_dir: str = ONNX_DIR, quantized: bool = False, n_threads: int | None = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        path = onnx_path(model_name, onnx_dir)
+        if not onnx_exists(model_name, onnx_dir, quantized):
+            raise FileNotFoundError(f"no exported onnx model in {path}, run scripts/export_onnx.py first")
+
+        config = json.loads((path / "encoder.json").read_text())
+        self.model_name = model_name
+        self.backend = "onnx-int8" if quantized else "onnx"
+        self.pooling = config["pooling"]
+        self.normalize = config["normalize"]
+        self.max_seq_length = config["max_seq_length"]
+        self.dim = config["dim"]
+        self.tokenizer = AutoTokenizer.from_pretrained(str(path))
+
+        options = ort.SessionOptions()
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(
+            str(path / ("model_int8.onnx" if quantized else "model.onnx")),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np")
+        feed = {name: encoded[name].astype(np.int64) for name in self.input_names}
+        hidden = self.session.run(None, feed)[0]
+        if self.pooling == "cls":
+            pooled = hidden[:, 0]
+        else:
+            mask = encoded["attention_mask"][:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        pooled = pooled.astype(np.float32)
+        if self.normalize:
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        if not len(texts):
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        embeddings = np.empty((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            embeddings[rows] = self._encode_batch([texts[i] for i in rows])
+
+        return embeddings[0] if single else embeddings
@@ -0,0 +1,118 @@
+'''
+phrase heatmaps with a bounded size: the lines x lines matrix is pooled to at most
+max_cells x max_cells bins before it goes to plotly or over the wire, so two
+400-line songs cost the same to draw as two 40-line ones. the best cells are
+written back with their exact score so pooling never hides the top pairs.
+zooming is the same thing on a slice of the matrix
+'''
+import base64
+from typing import NamedTuple
+import numpy as np
+
+from .similarity import TopK, top_k_cells
+from .metrics import timed
+
+MAX_CELLS = 100
+
+class Heatmap(NamedTuple):
+    values: np.ndarray     #float16 (row bins, col bins)
+    row_edges: np.ndarray  #row bin i covers lines row_edges[i]:row_edges[i + 1] of the first song
+    col_edges: np.ndarray
+    top: TopK              #exact best cells, (rows, cols) in line numbers of the full matrix
+
+    @property
+    def pooled(self) -> bool:
+        #False when every bin is a single line, i.e. the values are the matrix itself
+        rows, cols = self.values.shape
+        return rows < self.row_edges[-1] - self.row_edges[0] or cols < self.col_edges[-1] - self.col_edges[0]
+
+    @property
+    def row_labels(self) -> list[str]:
+        return edge_labels(self.row_edges)
+
+    @property
+    def col_labels(self) -> list[str]:
+        return edge_labels(self.col_edges)
+
+
+def edge_labels(edges: np.ndarray) -> list[str]:
+    #1-based line numbers, "5" for a single line and "5-8" for a bin
+    return [
+        f"{start + 1}" if stop - start == 1 else f"{start + 1}-{stop}"
+        for start, stop in zip(edges[:-1].tolist(), edges[1:].tolist())
+    ]
+
+def _bin_edges(start: int, stop: int, max_bins: int) -> np.ndarray:
+    #equal-ish bins, never empty since there are never more bins than lines
+    n_bins = min(stop - start, max_bins)
+    return np.linspace(start, stop, n_bins + 1).round().astype(np.int64)
+
+def _region(region, shape: tuple[int, int]) -> tuple[int, int, int, int]:
+    if region is None:
+        return 0, shape[0], 0, shape[1]
+    row_start, row_stop, col_start, col_stop = (int(x) for x in region)
+    row_start, col_start = max(row_start, 0), max(col_start, 0)
+    row_stop, col_stop = min(row_stop, shape[0]), min(col_stop, shape[1])
+    if row_start >= row_stop or col_start >= col_stop:
+        raise ValueError(f"empty region {tuple(region)} for a {shape[0]} x {shape[1]} matrix")
+    return row_start, row_stop, col_start, col_stop
+
+@timed("pool_heatmap")
+def pool_heatmap(
+    matrix: np.ndarray,
+    max_cells: int = MAX_CELLS,
+    mode: str = "max",
+    region: tuple[int, int, int, int] | None = None,
+    keep_top: int = 5
+    ) -> Heatmap:
+    '''
+    pools matrix (or the region rows row_start:row_stop, cols col_start:col_stop)
+    to at most max_cells bins per side. "max" shows the best pair in every bin,
+    "mean" the overall tone; either way the keep_top best cells keep their exact score
+    '''
+    if mode not in ("max", "mean"):
+        raise ValueError(f"unknown mode {mode}, use 'max' or 'mean'")
+    if max_cells < 1:
+        raise ValueError("max_cells must be at least 1")
+    matrix = np.asarray(matrix)
+    if matrix.ndim != 2 or matrix.size == 0:
+        raise ValueError(f"expected a non-empty 2-D matrix, got shape {matrix.shape}")
+
+    row_start, row_stop, col_start, col_stop = _region(region, matrix.shape)
+    block = np.asarray(matrix[row_start:row_stop, col_start:col_stop], dtype=np.float32)
+    row_edges = _bin_edges(row_start, row_stop, max_cells)
+    col_edges = _bin_edges(col_start, col_stop, max_cells)
+
+    #reduceat pools every bin of one axis in a single pass
+    if mode == "max":
+        pooled = np.maximum.reduceat(block, row_edges[:-1] - row_start, axis=0)
+        pooled = np.maximum.reduceat(pooled, col_edges[:-1] - col_start, axis=1)
+    else:
+        pooled = np.add.reduceat(block, row_edges[:-1] - row_start, axis=0)
+        pooled = np.add.reduceat(pooled, col_edges[:-1] - col_start, axis=1)
+        pooled /= np.outer(np.diff(row_edges), np.diff(col_edges))
+
+    (rows, cols), scores = top_k_cells(block, keep_top)
+    rows, cols = rows + row_start, cols + col_start
+    bin_rows = np.searchsorted(row_edges, rows, side="right") - 1
+    bin_cols = np.searchsorted(col_edges, cols, side="right") - 1
+    pooled[bin_rows, bin_cols] = np.maximum(pooled[bin_rows, bin_cols], scores)
+
+    return Heatmap(pooled.astype(np.float16), row_edges, col_edges, TopK((rows, cols), scores))
+
+
+def heatmap_payload(heatmap: Heatmap) -> dict:
+    #json-ready: values as base64 of little-endian float16, 2 bytes a cell
+    values = np.ascontiguousarray(heatmap.values, dtype="<f2")
+    (rows, cols), scores = heatmap.top
+    return {
+        "shape": list(values.shape),
+        "dtype": "float16",
+        "values": base64.b64encode(values.tobytes()).decode("ascii"),
+        "row_edges": heatmap.row_edges.tolist(),
+        "col_edges": heatmap.col_edges.tolist(),
+        "top": [
+            {"a": int(r), "b": int(c), "score": round(float(s), 4)}
+            for r, c, s in zip(rows, cols, scores)
+        ]
+    }
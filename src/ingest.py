@@ -0,0 +1,195 @@
+'''
+merge data/raw_data/*.csv into one columnar cache (plain npy files) so
+we don't parse csv text on every start
+'''
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from .text_processing import clean_lyrics_batch, make_song_keys
+
+try:
+    import fcntl
+except ImportError: #windows: no cross-process lock, start one process first to build the cache
+    fcntl = None
+
+CACHE_VERSION = 1
+RAW_COLUMNS = ["Artist", "Title", "Album", "Year", "Date", "Lyric"]
+NUMERIC_COLUMNS = ["Year"]
+
+def _file_hash(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _source_files(raw_dir: str) -> list[Path]:
+    return sorted(Path(raw_dir).glob("*.csv"))
+
+def _read_meta(cache_dir: str) -> dict | None:
+    path = Path(cache_dir) / "meta.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+def _unique_suffix() -> str:
+    return f"{os.getpid()}-{os.urandom(3).hex()}"
+
+@contextmanager
+def _flock(path: Path, shared: bool = False):
+    #cross-process lock on a side file, released when it is closed
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+def _lock_path(cache_dir: Path, kind: str) -> Path:
+    #"build" is held while one process builds, "swap" only while the folders are renamed
+    return cache_dir.with_name(f".{cache_dir.name}.{kind}.lock")
+
+def _write_meta(cache_dir: str, meta: dict):
+    path = Path(cache_dir) / "meta.json"
+    tmp = path.with_name(f"meta.json.{_unique_suffix()}.tmp")
+    tmp.write_text(json.dumps(meta, indent=1))
+    os.replace(tmp, path)
+
+def cache_is_fresh(raw_dir: str = "data/raw_data", cache_dir: str = "data/cache/songs") -> bool:
+    meta = _read_meta(cache_dir)
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return False
+
+    files = _source_files(raw_dir)
+    if sorted(meta["sources"]) != [f.name for f in files]:
+        return False
+
+    touched = False
+    for f in files:
+        source = meta["sources"][f.name]
+        stat = f.stat()
+        if source["mtime"] == stat.st_mtime and source["size"] == stat.st_size:
+            continue
+        #mtime changed (git checkout, copy...) but maybe not the content
+        if _file_hash(f) != source["sha1"]:
+            return False
+        source["mtime"] = stat.st_mtime
+        source["size"] = stat.st_size
+        touched = True
+
+    if touched:
+        _write_meta(cache_dir, meta)
+    return True
+
+def _save_string_column(path: Path, name: str, values: pd.Series):
+    #all strings glued together as utf-8 + byte offsets, nulls kept in a mask
+    null = values.isna().to_numpy()
+    encoded = [s.encode("utf-8") for s in values.fillna("").astype(str).tolist()]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(path / f"{name}.data.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(path / f"{name}.offsets.npy", offsets)
+    np.save(path / f"{name}.null.npy", null)
+
+def _load_string_column(path: Path, name: str) -> pd.Series:
+    data = np.load(path / f"{name}.data.npy", mmap_mode="r")
+    offsets = np.load(path / f"{name}.offsets.npy")
+    null = np.load(path / f"{name}.null.npy")
+    raw = data.tobytes()
+    values = pd.Series([raw[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])], dtype=object)
+    values[null] = None
+    return values
+
+def ingest_raw_data(
+    raw_dir: str = "data/raw_data",
+    cache_dir: str = "data/cache/songs",
+    force: bool = False
+    ) -> Path:
+    cache_dir = Path(cache_dir)
+    if not force and cache_is_fresh(raw_dir, cache_dir):
+        return cache_dir
+
+    #replicas starting together: one builds, the others wait and then find it fresh
+    with _flock(_lock_path(cache_dir, "build")):
+        if not force and cache_is_fresh(raw_dir, cache_dir):
+            return cache_dir
+        return _build_cache(raw_dir, cache_dir)
+
+def _build_cache(raw_dir: str, cache_dir: Path) -> Path:
+    files = _source_files(raw_dir)
+    if not files:
+        raise FileNotFoundError(f"no csv files in {raw_dir}")
+    print(f"ingesting {len(files)} csv files from {raw_dir}")
+
+    frames = []
+    for f in files:
+        frame = pd.read_csv(f)
+        frame = frame[[c for c in RAW_COLUMNS if c in frame.columns]].reindex(columns=RAW_COLUMNS)
+        frame["source"] = f.name
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+
+    df["song_key"] = make_song_keys(df)
+    df["display_title"] = df["Artist"] + " - " + df["Title"]
+    df["clean_lyric"] = clean_lyrics_batch(df["Lyric"].tolist())
+
+    #build in a side folder of our own and swap, readers never see half a cache
+    tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp-{_unique_suffix()}")
+    tmp_dir.mkdir(parents=True)
+    try:
+        columns = {}
+        for name in df.columns:
+            if name in NUMERIC_COLUMNS:
+                np.save(tmp_dir / f"{name}.npy", pd.to_numeric(df[name], errors="coerce").to_numpy(dtype=np.float64))
+                columns[name] = "numeric"
+            else:
+                _save_string_column(tmp_dir, name, df[name])
+                columns[name] = "string"
+
+        sources = {}
+        for f in files:
+            stat = f.stat()
+            sources[f.name] = {"mtime": stat.st_mtime, "size": stat.st_size, "sha1": _file_hash(f)}
+        _write_meta(tmp_dir, {"version": CACHE_VERSION, "n_rows": len(df), "columns": columns, "sources": sources})
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    #two renames can't be one atomic step: readers hold the swap lock shared, so they wait
+    #for both instead of finding no cache in between
+    old_dir = cache_dir.with_name(f"{cache_dir.name}.old-{_unique_suffix()}")
+    with _flock(_lock_path(cache_dir, "swap")):
+        if cache_dir.exists():
+            os.replace(cache_dir, old_dir)
+        os.replace(tmp_dir, cache_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    print(f"{len(df)} songs cached in: {cache_dir}")
+    return cache_dir
+
+def load_song_cache(cache_dir: str = "data/cache/songs", columns: list[str] | None = None) -> pd.DataFrame:
+    #only the requested columns are read from disk
+    cache_dir = Path(cache_dir)
+    with _flock(_lock_path(cache_dir, "swap"), shared=True):
+        meta = _read_meta(cache_dir)
+        if meta is None:
+            raise FileNotFoundError(f"no song cache in {cache_dir}, run ingest_raw_data first")
+
+        if columns is None:
+            columns = list(meta["columns"])
+        missing = [c for c in columns if c not in meta["columns"]]
+        if missing:
+            raise KeyError(f"columns not in cache: {missing}")
+
+        data = {}
+        for name in columns:
+            if meta["columns"][name] == "numeric":
+                data[name] = np.load(cache_dir / f"{name}.npy")
+            else:
+                data[name] = _load_string_column(cache_dir, name)
+    return pd.DataFrame(data, index=pd.RangeIndex(meta["n_rows"]))
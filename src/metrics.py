@@ -0,0 +1,222 @@
+'''
+where does the time go: stage timers, counters and histograms, exported in
+prometheus text format. off by default (TEXTWISE_METRICS=1 or enable()),
+and when off a timed function only pays one attribute check
+
+    @timed("load_songs")
+    def load_songs(...): ...
+
+    with timed("plotly_render"):
+        st.plotly_chart(fig)
+
+    count("encode_calls")
+    observe("encode_batch_size", len(texts), SIZE_BUCKETS)
+'''
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+#seconds, same idea as the prometheus client defaults but starting lower
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) #last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Registry:
+    def __init__(self):
+        self.enabled = os.environ.get("TEXTWISE_METRICS", "") not in ("", "0")
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+_REGISTRY = _Registry()
+
+def enable(on: bool = True):
+    _REGISTRY.enabled = on
+
+def is_enabled() -> bool:
+    return _REGISTRY.enabled
+
+def reset():
+    with _REGISTRY.lock:
+        _REGISTRY.counters.clear()
+        _REGISTRY.histograms.clear()
+
+def count(name: str, value: float = 1):
+    if not _REGISTRY.enabled:
+        return
+    with _REGISTRY.lock:
+        _REGISTRY.counters[name] = _REGISTRY.counters.get(name, 0) + value
+
+def observe(name: str, value: float, buckets: tuple = TIME_BUCKETS, stage: str | None = None):
+    if not _REGISTRY.enabled:
+        return
+    key = (name, stage)
+    with _REGISTRY.lock:
+        histogram = _REGISTRY.histograms.get(key)
+        if histogram is None:
+            histogram = _REGISTRY.histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+
+def record_encode(n_texts: int):
+    #one model.encode call: how many, how big
+    if not _REGISTRY.enabled:
+        return
+    count("encode_calls")
+    count("encoded_texts", n_texts)
+    observe("encode_batch_size", n_texts, SIZE_BUCKETS)
+
+
+class timed:
+    '''
+    latency of a stage into the stage_seconds histogram, as a decorator or a context manager.
+    nested stages are all recorded (load_data includes load_songs...)
+    '''
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _REGISTRY.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            observe("stage_seconds", time.perf_counter() - self.start, stage=self.name)
+            self.start = None
+        return False
+
+    def __call__(self, fn):
+        name = self.name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _REGISTRY.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe("stage_seconds", time.perf_counter() - start, stage=name)
+
+        return wrapper
+
+
+#one cProfile active at a time in a process (python 3.12+ refuses a second one)
+PROFILE_LOCK = threading.Lock()
+
+@contextmanager
+def profile(path: str | None = None, top: int = 25):
+    '''
+    opt-in cProfile of one block (one request, one rerun). with path the raw stats
+    are written there (snakeviz / pstats), otherwise the top functions by
+    cumulative time are printed. if another block is being profiled this one
+    isn't (yields None) instead of waiting for it
+    '''
+    if not PROFILE_LOCK.acquire(blocking=False):
+        yield None
+        return
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            save_profile(profiler, path, top)
+    finally:
+        PROFILE_LOCK.release()
+
+def save_profile(profiler: cProfile.Profile, path: str | None = None, top: int = 25):
+    #for profilers enabled somewhere else (e.g. in worker threads), same output as profile()
+    if path is not None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(path)
+    else:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top)
+        print(out.getvalue())
+
+def snapshot() -> dict:
+    #plain numbers, for /health or a quick print
+    with _REGISTRY.lock:
+        return {
+            "counters": dict(_REGISTRY.counters),
+            "histograms": {
+                (name if stage is None else f"{name}[{stage}]"): {"count": h.count, "sum": h.sum}
+                for (name, stage), h in _REGISTRY.histograms.items()
+            }
+        }
+
+def _format(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+def export_prometheus(prefix: str = "textwise", labels: dict | None = None) -> str:
+    #labels go on every sample, e.g. {"pid": "1234"} so files of several processes don't collide
+    extra = "".join(f'{key}="{value}",' for key, value in (labels or {}).items())
+    lines = []
+    with _REGISTRY.lock:
+        for name in sorted(_REGISTRY.counters):
+            metric = f"{prefix}_{name}_total"
+            counter_labels = "{" + extra.rstrip(",") + "}" if extra else ""
+            lines += [f"# TYPE {metric} counter", f"{metric}{counter_labels} {_format(_REGISTRY.counters[name])}"]
+
+        typed = set()
+        for (name, stage), h in sorted(_REGISTRY.histograms.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+            metric = f"{prefix}_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            labels = extra + (f'stage="{stage}",' if stage is not None else "")
+            cumulative = 0
+            for bound, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+                cumulative += n
+                le = bound if bound == "+Inf" else _format(bound)
+                lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {cumulative}')
+            labels = "{" + labels.rstrip(",") + "}" if labels else ""
+            lines.append(f"{metric}_sum{labels} {h.sum!r}")
+            lines.append(f"{metric}_count{labels} {h.count}")
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path: str = "metrics/textwise.prom", per_process: bool = True):
+    '''
+    atomic, so node_exporter's textfile collector never reads half a file.
+    with per_process every process gets its own file (textwise-<pid>.prom) and a pid label,
+    so app replicas don't overwrite each other (old pids' files stay until removed).
+    the tmp name is unique per thread and doesn't end in .prom, so the collector skips it
+    '''
+    path = Path(path)
+    labels = None
+    if per_process:
+        path = path.with_name(f"{path.stem}-{os.getpid()}{path.suffix}")
+        labels = {"pid": os.getpid()}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+    tmp.write_text(export_prometheus(labels=labels))
+    os.replace(tmp, path)
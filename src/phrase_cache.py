@@ -0,0 +1,154 @@
+'''
+cache of line embeddings so we don't run the model again for lines we already saw
+two tiers: an LRU in memory + an append-only memmap on disk
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+from .metrics import timed, count, record_encode
+
+try:
+    import fcntl
+except ImportError: #windows: no cross-process lock, use one folder per process there
+    fcntl = None
+
+class PhraseEmbeddingCache:
+    '''
+    keys are sha1(model name + line), values are L2-normalized vectors,
+    so comparing two cached sets of lines is just a matrix multiply.
+
+    disk layout (one folder per model):
+        vectors.f32 -> raw float32 rows, appended
+        keys.txt    -> "key row" per line, row is where the vector sits in vectors.f32
+    appends take an flock on the folder, so threads, app sessions and service
+    replicas can share it. a vector without its key line is just never read
+    '''
+
+    def __init__(
+        self,
+        model_name: str,
+        cache_dir: str | None = "embeddings/phrase_cache",
+        max_memory_items: int = 20000
+        ):
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.dir = None
+        self.disk_rows: dict[str, int] = {}
+        self._n_disk_rows = 0
+        self._lock = threading.RLock()
+        self.dim = None
+        self._vectors = None
+        if cache_dir is not None:
+            self.dir = Path(cache_dir) / model_name.replace("/", "__")
+            self._load_disk_index()
+
+    def __len__(self) -> int:
+        return len(self.disk_rows) if self.dir else len(self.memory)
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _load_disk_index(self):
+        keys_path = self.dir / "keys.txt"
+        vectors_path = self.dir / "vectors.f32"
+        dim_path = self.dir / "dim.txt"
+        if not keys_path.exists() or not dim_path.exists():
+            return
+
+        self.dim = int(dim_path.read_text())
+        self._n_disk_rows = vectors_path.stat().st_size // (4 * self.dim) if vectors_path.exists() else 0
+        for line_number, line in enumerate(keys_path.read_text().splitlines()):
+            fields = line.split()
+            if not fields:
+                continue
+            #old caches have only the key, the row was the line number
+            row = int(fields[1]) if len(fields) > 1 else line_number
+            #a key whose vector never made it to disk is dropped
+            if row < self._n_disk_rows:
+                self.disk_rows[fields[0]] = row
+
+    def _disk_vectors(self) -> np.ndarray:
+        if self._vectors is None or len(self._vectors) < self._n_disk_rows:
+            self._vectors = np.memmap(self.dir / "vectors.f32", dtype=np.float32, mode="r", shape=(self._n_disk_rows, self.dim))
+        return self._vectors
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, text: str) -> np.ndarray | None:
+        key = self.key(text)
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if key in self.disk_rows:
+                vector = np.array(self._disk_vectors()[self.disk_rows[key]])
+                self._remember(key, vector)
+                return vector
+        return None
+
+    def put_many(self, texts: list[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+
+            if self.dir is None:
+                return
+
+            new = list({keys[i]: i for i in range(len(keys)) if keys[i] not in self.disk_rows}.values())
+            if not new:
+                return
+
+            self.dir.mkdir(parents=True, exist_ok=True)
+            with open(self.dir / "vectors.f32", "ab") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX) #released when f is closed
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    (self.dir / "dim.txt").write_text(str(self.dim))
+
+                #rows come from the file size under the lock, so orphan vectors
+                #or other writers can't shift them. vectors first, keys second
+                f.seek(0, 2)
+                first_row = f.tell() // (4 * self.dim)
+                f.write(vectors[new].tobytes())
+                f.flush()
+                with open(self.dir / "keys.txt", "a") as keys_file:
+                    keys_file.write("".join(f"{keys[i]} {first_row + j}\n" for j, i in enumerate(new)))
+
+            for j, i in enumerate(new):
+                self.disk_rows[keys[i]] = first_row + j
+            self._n_disk_rows = max(self._n_disk_rows, first_row + len(new))
+
+    def encode(self, texts: list[str], model, batch_size: int = 64) -> np.ndarray:
+        vectors = [self.get(text) for text in texts]
+
+        missing = list(dict.fromkeys(text for text, vec in zip(texts, vectors) if vec is None))
+        self.hits += len(texts) - sum(vec is None for vec in vectors)
+        self.misses += len(missing)
+        count("phrase_cache_hits", len(texts) - sum(vec is None for vec in vectors))
+        count("phrase_cache_misses", len(missing))
+
+        if missing:
+            record_encode(len(missing))
+            with timed("model_encode"):
+                encoded = model.encode(missing, batch_size=batch_size, convert_to_numpy=True)
+            encoded = encoded / np.maximum(np.linalg.norm(encoded, axis=1, keepdims=True), 1e-12)
+            self.put_many(missing, encoded)
+            found = dict(zip(missing, encoded.astype(np.float32)))
+            vectors = [found[text] if vec is None else vec for text, vec in zip(texts, vectors)]
+
+        if not vectors:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.stack(vectors)
@@ -0,0 +1,139 @@
+'''
+title/artist search without scanning the whole table on every keystroke:
+lowercased columns are computed once, sorted arrays answer the exact / prefix /
+word-prefix ranks with searchsorted and a trigram index gives the rest
+'''
+import re
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+#positions right after a non-alphanumeric character, where a word can start
+_WORD_START = re.compile(r"(?<=[\W_])(?=.)", re.S)
+#sorts after every string that starts with the query
+_MAX_CHAR = "\U0010ffff"
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _sorted_keys(keys: list[str], rows: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    #python's sort on a list of str is a lot faster than argsort on an object array
+    order = np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int64)
+    return np.array(keys, dtype=object)[order], np.asarray(rows, dtype=np.int32)[order]
+
+def _prefix_rows(keys: np.ndarray, rows: np.ndarray, prefix: str) -> np.ndarray:
+    #every key starting with prefix is one contiguous run of the sorted array
+    start = np.searchsorted(keys, prefix, side="left")
+    stop = np.searchsorted(keys, prefix + _MAX_CHAR, side="left")
+    return rows[start:stop]
+
+class SongSearchIndex:
+    '''
+    queries are plain text (never regex), matched case-insensitively as a
+    substring of the title or the artist. results are ranked:
+    exact > starts with > a word starts with > anywhere, then shorter titles first.
+    ranks are filled best first and the search stops once limit rows are found,
+    so a one-letter query doesn't rank the whole table.
+    with fuzzy=True and not enough hits, titles sharing most of the query's
+    trigrams are added too (typos like "bilie elish")
+    '''
+
+    def __init__(self, titles: list[str], artists: list[str]):
+        self.titles = [str(t).lower() if isinstance(t, str) else "" for t in titles]
+        self.artists = [str(a).lower() if isinstance(a, str) else "" for a in artists]
+        self.title_len = np.array([len(t) for t in self.titles], dtype=np.int32)
+        #one string per song for the substring pass, \0 so a match can't span both fields
+        self.haystack = [f"{title}\0{artist}" for title, artist in zip(self.titles, self.artists)]
+
+        n_songs = len(self.titles)
+        rows = list(range(n_songs))
+        self.fields = _sorted_keys(self.titles + self.artists, rows + rows)
+
+        word_keys, word_rows = [], []
+        postings = defaultdict(list)
+        for row, (title, artist) in enumerate(zip(self.titles, self.artists)):
+            for field in (title, artist):
+                for match in _WORD_START.finditer(field):
+                    word_keys.append(field[match.start():])
+                    word_rows.append(row)
+            for gram in _trigrams(title) | _trigrams(artist):
+                postings[gram].append(row)
+        self.words = _sorted_keys(word_keys, word_rows)
+        self.postings = {gram: np.array(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame) -> "SongSearchIndex":
+        return cls(df["Title"].tolist(), df["Artist"].tolist())
+
+    def _candidates(self, query: str) -> np.ndarray:
+        if len(query) < 3:
+            return np.arange(len(self), dtype=np.int32) #too short for trigrams, check everything
+        #rows that have every trigram of the query, smallest posting lists first
+        lists = sorted((self.postings.get(gram) for gram in _trigrams(query)), key=lambda p: -1 if p is None else len(p))
+        if lists[0] is None:
+            return np.empty(0, dtype=np.int32)
+        candidates = lists[0]
+        for posting in lists[1:]:
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            if not len(candidates):
+                break
+        return candidates
+
+    def _substring_rows(self, query: str) -> np.ndarray:
+        haystack = self.haystack
+        rows = [row for row in self._candidates(query).tolist() if query in haystack[row]]
+        return np.array(rows, dtype=np.int32)
+
+    def _tiers(self, query: str):
+        #rows of each rank, best rank first; a row can show up again in a worse one
+        keys, rows = self.fields
+        prefix = _prefix_rows(keys, rows, query)
+        exact = np.searchsorted(keys, query, side="right") - np.searchsorted(keys, query, side="left")
+        yield prefix[:exact] #the run of exact matches comes first in the prefix run
+        yield prefix[exact:]
+        yield _prefix_rows(*self.words, query)
+        yield self._substring_rows(query)
+
+    def _fuzzy(self, query: str, exclude: set[int], min_overlap: float) -> list[int]:
+        grams = [self.postings[g] for g in _trigrams(query) if g in self.postings]
+        if not grams:
+            return []
+        hits = np.bincount(np.concatenate(grams), minlength=len(self))
+        score = hits / max(len(_trigrams(query)), 1)
+        rows = np.flatnonzero(score >= min_overlap)
+        rows = rows[np.lexsort((self.title_len[rows], -score[rows]))]
+        return [int(r) for r in rows if r not in exclude]
+
+    def search(self, query: str, limit: int = 50, fuzzy: bool = True, min_overlap: float = 0.5) -> np.ndarray:
+        #spaces are part of the literal ("love " != "love"), they only don't count as a query on their own
+        query = query.lower()
+        if not query.strip():
+            return np.arange(min(limit, len(self)), dtype=np.int64)
+
+        results = []
+        seen = np.zeros(len(self), dtype=bool)
+        for rows in self._tiers(query):
+            #unique rows of this rank not taken by a better one, in table order
+            tier = np.zeros(len(self), dtype=bool)
+            tier[rows] = True
+            tier &= ~seen
+            seen |= tier
+            rows = np.flatnonzero(tier)
+
+            #shorter titles first, then table order; only the rows that can still make the cut get sorted
+            need = limit - len(results)
+            lengths = self.title_len[rows]
+            if len(rows) > need:
+                cutoff = np.partition(lengths, need - 1)[need - 1]
+                rows, lengths = rows[lengths <= cutoff], lengths[lengths <= cutoff]
+            results.extend(rows[np.lexsort((rows, lengths))][:need].tolist())
+            if len(results) >= limit:
+                break
+
+        if fuzzy and len(results) < limit and len(query) >= 3:
+            results += self._fuzzy(query, set(results), min_overlap)[:limit - len(results)]
+
+        return np.array(results, dtype=np.int64)
@@ -0,0 +1,549 @@
+'''
+headless version of the app: a small asyncio HTTP/JSON server over the src package
+
+    python -m src.service --port 8000
+
+GET  /health
+GET  /metrics   (prometheus text format)
+GET  /similar?song_id=12&n=10
+POST /phrases   {"song_a": 12, "song_b": 40, "top": 5}
+POST /heatmap   {"song_a": 12, "song_b": 40, "max_cells": 100, "region": [0, 40, 0, 40]}
+POST /search    {"query": "dancing alone at night", "n": 10}
+
+model.encode calls from concurrent requests are grouped into micro-batches
+(MicroBatcher) and all CPU work runs in a thread pool, off the event loop.
+any request with ?profile=1 has its thread-pool work run under cProfile (in the
+worker thread, so other requests don't end up in the stats), stats go to profiles/.
+shared micro-batched encodes belong to several requests and are not included
+'''
+import argparse
+import asyncio
+import contextvars
+import cProfile
+import functools
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+
+from .text_processing import load_songs, split_into_sentences
+from .embeddings import DEFAULT_MODEL, load_model, show_embeddings, load_line_embeddings, line_embeddings_exist
+from .similarity import NeighborIndex, IVFIndex, near_duplicate_groups, find_most_similar, calc_line_similarity, get_top_phrase_pairs, semantic_search
+from .heatmap import MAX_CELLS, pool_heatmap, heatmap_payload
+from .phrase_cache import PhraseEmbeddingCache
+from .ingest import ingest_raw_data
+from . import metrics
+from .artifacts import ARTIFACT_ROOT, EMBEDDINGS_FILE, ArtifactMismatchError, artifact_dir, validate_embeddings
+
+#bigger bodies get a 413 before anything is read, no endpoint needs more than a few KB
+MAX_BODY_BYTES = 1 << 20
+
+#profiler of the request being handled, set by dispatch for ?profile=1
+_PROFILER: contextvars.ContextVar[cProfile.Profile | None] = contextvars.ContextVar("profiler", default=None)
+
+def _profiled(profiler: cProfile.Profile, fn, *args):
+    #metrics.PROFILE_LOCK: one cProfile active at a time (python 3.12+ refuses a second one)
+    with metrics.PROFILE_LOCK:
+        profiler.enable()
+        try:
+            return fn(*args)
+        finally:
+            profiler.disable()
+
+
+class MicroBatcher:
+    '''
+    collects texts from concurrent callers and encodes them together:
+    a batch is sent when it has max_batch_size texts or when the first
+    text in it has waited max_wait_ms, whichever comes first
+    '''
+
+    def __init__(self, encode_fn, executor, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.encode_fn = encode_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = None
+        self.batches = 0
+        self.texts = 0
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def encode(self, texts: list[str]) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            n_texts = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+
+            while n_texts < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                n_texts += len(item[0])
+
+            #same text asked twice in one batch -> encoded once
+            unique = list(dict.fromkeys(text for texts, _ in pending for text in texts))
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.encode_fn, unique)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.texts += len(unique)
+            metrics.count("encode_batches")
+            metrics.observe("encode_batch_size", len(unique), metrics.SIZE_BUCKETS)
+            metrics.observe("encode_batch_requests", len(pending), metrics.SIZE_BUCKETS)
+            row = {text: i for i, text in enumerate(unique)}
+            for texts, future in pending:
+                if not future.done():
+                    future.set_result(vectors[[row[text] for text in texts]])
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class TextwiseService:
+
+    def __init__(
+        self,
+        cache_dir: str = "data/cache/songs",
+        artifact_root: str = ARTIFACT_ROOT,
+        model_name: str = DEFAULT_MODEL,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+        n_threads: int = 4,
+        backend: str = "torch",
+        reload_every_s: float = 5.0
+        ):
+        ingest_raw_data("data/raw_data", cache_dir)
+        self.df = load_songs(cache_dir, columns=["Artist", "Title", "song_key", "display_title", "clean_lyric"])
+        self.artifact_root = artifact_root
+        self.reload_every_s = reload_every_s
+        self.model_name = model_name
+        self._swap(self._load_artifacts(artifact_dir(artifact_root)))
+        self.failed_artifacts = None #last version that failed to load, /health shows it
+
+        self.backend = backend
+        self.model = None #loaded on the first encode
+        #onnx-int8 vectors are a bit off from torch ones, they don't share cached vectors
+        cache_name = model_name if backend == "torch" else f"{model_name}__{backend}"
+        self.phrase_cache = PhraseEmbeddingCache(cache_name, "embeddings/phrase_cache")
+        self.query_cache = PhraseEmbeddingCache(cache_name, cache_dir=None, max_memory_items=10000)
+        self.executor = ThreadPoolExecutor(n_threads)
+        self.batcher = MicroBatcher(self._encode, self.executor, max_batch_size, max_wait_ms)
+
+    def _load_artifacts(self, artifacts) -> dict:
+        #everything that depends on the embeddings version, checked against the songs before it is used
+        path = f"{artifacts}/{EMBEDDINGS_FILE}"
+        embeddings = show_embeddings(path, mmap=True)
+        manifest = validate_embeddings(path, embeddings=embeddings, song_keys=self.df["song_key"].tolist(),
+                                       lyrics=self.df["clean_lyric"].tolist(), model_name=self.model_name)
+        normalized = bool(manifest.get("normalized"))
+
+        if NeighborIndex.exists(f"{artifacts}/neighbors"):
+            neighbors = NeighborIndex.load(f"{artifacts}/neighbors")
+        else:
+            neighbors = NeighborIndex.build(embeddings, k=50)
+        #same grouping as the app: work_id joined with the near-identical lyrics
+        groups = near_duplicate_groups(neighbors, threshold=0.97, groups=self.df["work_id"].to_numpy())
+
+        lines = None
+        if line_embeddings_exist(f"{artifacts}/lines"):
+            line_embeddings, line_offsets = load_line_embeddings(f"{artifacts}/lines")
+            if len(line_offsets) == len(self.df) + 1:
+                lines = (line_embeddings, line_offsets)
+
+        #generate_embeddings.py --ivf: search scans a few buckets instead of every row
+        song_ivf = line_ivf = None
+        if IVFIndex.exists(f"{artifacts}/ivf"):
+            song_ivf = IVFIndex.load(f"{artifacts}/ivf")
+            if len(song_ivf) != len(embeddings):
+                song_ivf = None
+        if lines is not None and IVFIndex.exists(f"{artifacts}/ivf/lines"):
+            line_ivf = IVFIndex.load(f"{artifacts}/ivf/lines")
+            if len(line_ivf) != len(lines[0]):
+                line_ivf = None
+
+        return {
+            "artifacts": str(artifacts),
+            "embeddings": embeddings,
+            "normalized": normalized,
+            "norms": None if normalized else np.linalg.norm(embeddings, axis=1).astype(np.float32),
+            "neighbors": neighbors,
+            "groups": groups,
+            "lines": lines,
+            "song_ivf": song_ivf,
+            "line_ivf": line_ivf
+        }
+
+    def _swap(self, state: dict):
+        #plain attribute assignments on the event loop thread: a request sees the old version or the new one
+        self.artifacts = state["artifacts"]
+        self.embeddings = state["embeddings"]
+        self.normalized = state["normalized"]
+        self.norms = state["norms"]
+        self.neighbors = state["neighbors"]
+        self.groups = state["groups"]
+        self.lines = state["lines"]
+        self.song_ivf = state["song_ivf"]
+        self.line_ivf = state["line_ivf"]
+
+    async def watch_artifacts(self):
+        #zero-downtime rollout: when CURRENT moves, load the new version off the loop and swap
+        while True:
+            await asyncio.sleep(self.reload_every_s)
+            artifacts = str(artifact_dir(self.artifact_root))
+            if artifacts in (self.artifacts, self.failed_artifacts):
+                continue
+            try:
+                state = await self._run_cpu(self._load_artifacts, artifacts)
+            except (ArtifactMismatchError, OSError) as e:
+                print(f"not switching to {artifacts}: {e}")
+                self.failed_artifacts = artifacts #don't retry the same broken version every few seconds
+                continue
+            self._swap(state)
+            print(f"now serving {artifacts}")
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        if self.model is None:
+            self.model = load_model(self.model_name, backend=self.backend)
+        embeddings = self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    async def _run_cpu(self, fn, *args):
+        profiler = _PROFILER.get()
+        if profiler is not None:
+            fn = functools.partial(_profiled, profiler, fn)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _song(self, song_id) -> int:
+        try:
+            song_id = int(song_id)
+        except (TypeError, ValueError):
+            raise HTTPError(400, f"bad song id: {song_id!r}")
+        if not 0 <= song_id < len(self.df):
+            raise HTTPError(404, f"no song with id {song_id}")
+        return song_id
+
+    def _count(self, params: dict, name: str, default: int, maximum: int = 1000) -> int:
+        #n, top, lines...: a positive int, capped so one request can't ask for everything
+        value = params.get(name, default)
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise HTTPError(400, f"{name} must be a positive integer")
+        try:
+            value = int(value)
+        except ValueError:
+            raise HTTPError(400, f"{name} must be a positive integer")
+        if value < 1:
+            raise HTTPError(400, f"{name} must be a positive integer")
+        return min(value, maximum)
+
+    def _song_json(self, song_id: int, score: float | None = None) -> dict:
+        song = {
+            "song_id": song_id,
+            "artist": self.df.column("Artist")[song_id],
+            "title": self.df.column("Title")[song_id]
+        }
+        if score is not None:
+            song["score"] = round(float(score), 4)
+        return song
+
+    async def encode_lines(self, lines: list[str]) -> np.ndarray:
+        #cached lines come back right away, the rest go through the batcher.
+        #the cache reads disk and put_many waits on its flock: both in the pool
+        vectors = await self._run_cpu(lambda: [self.phrase_cache.get(line) for line in lines])
+        missing = list(dict.fromkeys(line for line, vec in zip(lines, vectors) if vec is None))
+        if missing:
+            encoded = await self.batcher.encode(missing)
+            await self._run_cpu(self.phrase_cache.put_many, missing, encoded)
+            found = dict(zip(missing, encoded))
+            vectors = [found[line] if vec is None else vec for line, vec in zip(lines, vectors)]
+        return np.stack(vectors).astype(np.float32)
+
+    async def similar(self, params: dict) -> dict:
+        song_id = self._song(params.get("song_id"))
+        n = self._count(params, "n", 10)
+        results = await self._run_cpu(
+            functools.partial(find_most_similar, groups=self.groups, embeddings=self.embeddings), song_id, self.neighbors, n
+        )
+        return {"song": self._song_json(song_id), "similar": [self._song_json(i, s) for i, s in results]}
+
+    def _song_lines(self, *song_ids: int) -> list[list[str]]:
+        lyrics = self.df.column("clean_lyric")
+        return [split_into_sentences(lyrics[song_id]) for song_id in song_ids]
+
+    async def _phrase_matrix(self, song_a: int, song_b: int) -> tuple[list[str], list[str], np.ndarray | None]:
+        phrases_a, phrases_b = await self._run_cpu(self._song_lines, song_a, song_b)
+        if not phrases_a or not phrases_b:
+            return phrases_a, phrases_b, None
+
+        if self.lines is not None:
+            matrix = await self._run_cpu(calc_line_similarity, song_a, song_b, *self.lines)
+        else:
+            emb_a, emb_b = await asyncio.gather(self.encode_lines(phrases_a), self.encode_lines(phrases_b))
+            matrix = await self._run_cpu(np.dot, emb_a, emb_b.T)
+        return phrases_a, phrases_b, matrix
+
+    async def phrases(self, params: dict) -> dict:
+        song_a = self._song(params.get("song_a"))
+        song_b = self._song(params.get("song_b"))
+        top = self._count(params, "top", 5)
+
+        phrases_a, phrases_b, matrix = await self._phrase_matrix(song_a, song_b)
+        if matrix is None:
+            return {"shape": [len(phrases_a), len(phrases_b)], "pairs": []}
+
+        pairs = await self._run_cpu(get_top_phrase_pairs, matrix, phrases_a, phrases_b, top)
+        return {
+            "shape": list(matrix.shape),
+            "pairs": [{"a": a, "b": b, "score": round(score, 4)} for a, b, score in pairs]
+        }
+
+    async def heatmap(self, params: dict) -> dict:
+        #pooled phrase heatmap, at most max_cells x max_cells float16 values whatever the song lengths
+        song_a = self._song(params.get("song_a"))
+        song_b = self._song(params.get("song_b"))
+        max_cells = self._count(params, "max_cells", MAX_CELLS, maximum=4 * MAX_CELLS)
+        region = params.get("region")
+        if isinstance(region, str):
+            region = region.split(",")
+        if region is not None and len(region) != 4:
+            raise HTTPError(400, "region is row_start,row_stop,col_start,col_stop")
+
+        phrases_a, phrases_b, matrix = await self._phrase_matrix(song_a, song_b)
+        if matrix is None:
+            raise HTTPError(404, "one of the songs has no lyrics")
+
+        heatmap = await self._run_cpu(
+            pool_heatmap, matrix, max_cells, params.get("mode", "max"), region, self._count(params, "top", 5)
+        )
+        return {"lines": [len(phrases_a), len(phrases_b)], **heatmap_payload(heatmap)}
+
+    async def search(self, params: dict) -> dict:
+        query = str(params.get("query", "")).strip()
+        if not query:
+            raise HTTPError(400, "empty query")
+        n = self._count(params, "n", 10)
+        n_lines = self._count(params, "lines", 5)
+
+        query_vec = self.query_cache.get(query)
+        if query_vec is None:
+            query_vec = (await self.batcher.encode([query]))[0]
+            self.query_cache.put_many([query], query_vec[None, :])
+
+        line_embeddings, line_offsets = self.lines if self.lines is not None else (None, None)
+        song_rows = self.song_ivf if self.song_ivf is not None else self.embeddings
+        line_rows = self.line_ivf if self.line_ivf is not None else line_embeddings
+        songs, lines = await self._run_cpu(
+            semantic_search, query_vec, song_rows, n, self.norms, line_rows, line_offsets, n_lines, self.normalized
+        )
+        texts = await self._run_cpu(self._line_texts, lines)
+        return {
+            "query": query,
+            "results": [self._song_json(i, s) for i, s in songs],
+            "lines": [
+                {**self._song_json(song, s), "line": line, "text": text}
+                for (song, line, s), text in zip(lines, texts)
+            ]
+        }
+
+    def _line_texts(self, lines: list[tuple[int, int, float]]) -> list[str]:
+        #each song is split once even if several of its lines were found
+        song_ids = list(dict.fromkeys(song for song, _, _ in lines))
+        split = dict(zip(song_ids, self._song_lines(*song_ids)))
+        return [split[song][line] for song, line, _ in lines]
+
+    async def prometheus(self, params: dict) -> str:
+        return metrics.export_prometheus()
+
+    async def health(self, params: dict) -> dict:
+        return {
+            "status": "ok",
+            "songs": len(self.df),
+            "artifacts": self.artifacts,
+            "failed_artifacts": self.failed_artifacts,
+            "encode_batches": self.batcher.batches,
+            "encoded_texts": self.batcher.texts
+        }
+
+    ROUTES = {
+        ("GET", "/health"): "health",
+        ("GET", "/metrics"): "prometheus",
+        ("GET", "/similar"): "similar",
+        ("GET", "/phrases"): "phrases",
+        ("POST", "/phrases"): "phrases",
+        ("GET", "/heatmap"): "heatmap",
+        ("POST", "/heatmap"): "heatmap",
+        ("GET", "/search"): "search",
+        ("POST", "/search"): "search"
+    }
+
+    async def dispatch(self, method: str, target: str, body: bytes) -> tuple[int, dict]:
+        url = urlsplit(target)
+        handler = self.ROUTES.get((method, url.path))
+        if handler is None:
+            return 404, {"error": f"no route {method} {url.path}"}
+
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if body:
+            try:
+                params.update(json.loads(body))
+            except (ValueError, TypeError):
+                return 400, {"error": "body is not valid json"}
+
+        start = time.perf_counter()
+        try:
+            if str(params.pop("profile", "")) in ("1", "true"):
+                profiler = cProfile.Profile()
+                token = _PROFILER.set(profiler)
+                try:
+                    return 200, await getattr(self, handler)(params)
+                finally:
+                    _PROFILER.reset(token)
+                    metrics.save_profile(profiler, f"profiles/{handler}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+            return 200, await getattr(self, handler)(params)
+        except HTTPError as e:
+            metrics.count(f"http_errors_{e.status}")
+            return e.status, {"error": e.message}
+        except ValueError as e:
+            metrics.count("http_errors_400")
+            return 400, {"error": str(e)}
+        except Exception as e:
+            #a bug in a handler is a 500 for that request, not a dropped connection
+            traceback.print_exc()
+            metrics.count("http_errors_500")
+            return 500, {"error": f"internal error: {type(e).__name__}"}
+        finally:
+            metrics.observe("request_seconds", time.perf_counter() - start, stage=handler)
+
+    def _check_length(self, value: str) -> tuple[int | None, dict | None]:
+        #(None, None) if the body can be read, else the error response
+        try:
+            length = int(value or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            metrics.count("http_errors_400")
+            return 400, {"error": f"bad content-length: {value!r}"}
+        if length > MAX_BODY_BYTES:
+            metrics.count("http_errors_413")
+            return 413, {"error": f"body over {MAX_BODY_BYTES} bytes"}
+        return None, None
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        #minimal HTTP/1.1 with keep-alive, enough for a load balancer in front
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                status, payload = self._check_length(headers.get("content-length", ""))
+                if status is None:
+                    body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                    status, payload = await self.dispatch(method.upper(), target, body)
+                else:
+                    #the body was never read, the connection can't be reused
+                    headers["connection"] = "close"
+                if isinstance(payload, str):
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                    payload = payload.encode("utf-8")
+                else:
+                    content_type = "application/json; charset=utf-8"
+                    payload = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"X-Elapsed-Ms: {(time.perf_counter() - start) * 1000:.2f}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        self.batcher.start()
+        watcher = asyncio.create_task(self.watch_artifacts()) if self.reload_every_s else None
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"textwise service on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            await self.batcher.stop()
+            self.executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=64, help="texts per model.encode call")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="how long a text waits for others to join its batch")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--backend", choices=["torch", "onnx", "onnx-int8"], default="torch", help="onnx ones need scripts/export_onnx.py first")
+    parser.add_argument("--no-metrics", action="store_true", help="turn off the /metrics timers and counters")
+    parser.add_argument("--reload-every", type=float, default=5.0, help="seconds between checks of embeddings/CURRENT, 0 to never reload")
+    args = parser.parse_args()
+    metrics.enable(not args.no_metrics)
+
+    service = TextwiseService(
+        max_batch_size=args.max_batch,
+        max_wait_ms=args.max_wait_ms,
+        n_threads=args.threads,
+        backend=args.backend,
+        reload_every_s=args.reload_every
+    )
+    asyncio.run(service.serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,797 @@
 '''
 file to calculate similiarity between texts 
 '''
+import json
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity #idk what happened but apparenlty requirement already satisfied 
+import pandas as pd
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from .store import QuantizedEmbeddings
+from .metrics import timed, record_encode
 
-def compute_similarity_matrix(embeddings: np.ndarray) -> np.ndarray:
-    #idk but i have to do some weird stuff
-    return cosine_similarity(embeddings)
+def l2_normalize(embeddings: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    #rows with norm 1 as contiguous float32 (zero rows stay zero), out=embeddings does it in place
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.divide(embeddings, norms, out=out)
 
+def cosine_scores(
+    a: np.ndarray,
+    b: np.ndarray | None = None,
+    normalized: bool = False,
+    out: np.ndarray | None = None
+    ) -> np.ndarray:
+    '''
+    cosine of every row of a against every row of b (b=None: a against itself).
+    it's one BLAS float32 matmul; with normalized=True (embeddings saved by
+    generate_save_embeddings are) the norms are skipped too, and out= reuses a
+    (len(a), len(b)) float32 buffer instead of allocating one per call
+    '''
+    if normalized:
+        a = np.ascontiguousarray(a, dtype=np.float32)
+        b = a if b is None else np.ascontiguousarray(b, dtype=np.float32)
+    else:
+        b = None if b is None or b is a else l2_normalize(b)
+        a = l2_normalize(a)
+        b = a if b is None else b
+    return np.dot(a, b.T, out=out)
+
+@timed("compute_similarity_matrix")
+def compute_similarity_matrix(
+    embeddings: np.ndarray,
+    normalized: bool = False,
+    out: np.ndarray | None = None
+    ) -> np.ndarray:
+    #same numbers as sklearn's cosine_similarity without its checks and copies
+    return cosine_scores(embeddings, normalized=normalized, out=out)
+
+class TopK(NamedTuple):
+    #indices are -1 (and scores -inf) where there weren't k valid candidates
+    indices: np.ndarray
+    scores: np.ndarray
+
+
+def _sorted_top(scores: np.ndarray, k: int) -> np.ndarray:
+    #argpartition gets the k best per row in O(N), then we only sort those k
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+def _group_top(row: np.ndarray, k: int, groups: np.ndarray) -> np.ndarray:
+    #best row per group: fetch a few more than k, drop repeated groups, fetch more if that wasn't enough
+    n = len(row)
+    fetch = min(n, max(2 * k, 16))
+    while True:
+        cand = _sorted_top(row[None, :], fetch)[0]
+        cand = cand[row[cand] > -np.inf]
+        _, first = np.unique(groups[cand], return_index=True)
+        keep = cand[np.sort(first)] #candidates come sorted, so the first of each group is its best
+        if len(keep) >= k or fetch >= n or len(cand) < fetch:
+            return keep[:k]
+        fetch = min(n, fetch * 4)
+
+
+def top_k(
+    scores: np.ndarray,
+    k: int,
+    exclude=None,
+    groups: np.ndarray | None = None
+    ) -> TopK:
+    '''
+    the k highest scores (sorted) of a 1-D array, or of every row of a 2-D batch.
+    exclude: boolean mask (True = skip) shaped like scores or like one row,
+    or integer column(s) to skip, one per row (e.g. the song itself).
+    groups: one key per column (artist id, work id...), only the best column
+    of each key is kept so the k results have k different keys
+    '''
+    scores = np.asarray(scores)
+    single = scores.ndim == 1
+    if single:
+        scores = scores[None, :]
+
+    if exclude is not None:
+        scores = np.array(scores, dtype=np.result_type(scores.dtype, np.float32)) #copy, the caller's array stays intact
+        exclude = np.asarray(exclude)
+        if exclude.dtype == bool:
+            scores[np.broadcast_to(exclude, scores.shape)] = -np.inf
+        else:
+            scores[np.arange(len(scores)), exclude.reshape(len(scores))] = -np.inf
+
+    if groups is None:
+        indices = _sorted_top(scores, k)
+    else:
+        groups = np.asarray(groups)
+        width = min(k, scores.shape[1])
+        indices = np.full((len(scores), width), -1, dtype=np.int64)
+        for r, row in enumerate(scores):
+            keep = _group_top(row, width, groups)
+            indices[r, :len(keep)] = keep
+
+    values = np.take_along_axis(scores, np.maximum(indices, 0), axis=1).astype(np.float32)
+    invalid = (indices < 0) | (values == -np.inf)
+    if invalid.any():
+        indices = np.where(invalid, -1, indices)
+        values[invalid] = -np.inf
+
+    if single:
+        return TopK(indices[0], values[0])
+    return TopK(indices, values)
+
+
+def top_k_cells(matrix: np.ndarray, k: int) -> TopK:
+    #k highest cells of a 2-D matrix, indices come back as (rows, cols)
+    matrix = np.asarray(matrix)
+    if matrix.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return TopK((empty, empty), np.empty(0, dtype=np.float32))
+    flat = top_k(matrix.ravel(), k)
+    return TopK(np.unravel_index(flat.indices, matrix.shape), flat.scores)
+
+
+class NeighborIndex:
+    '''
+    top-k neighbors of every song, precomputed once.
+    replaces the N x N matrix: memory is N * k instead of N * N
+    '''
+
+    def __init__(self, indices: np.ndarray, scores: np.ndarray):
+        self.indices = indices
+        self.scores = scores
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @property
+    def k(self) -> int:
+        return self.indices.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.indices.nbytes + self.scores.nbytes
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        k: int = 50,
+        block_size: int = 1024,
+        tile_size: int | None = 4096,
+        n_jobs: int = 1,
+        score_dtype=np.float32
+        ) -> "NeighborIndex":
+        '''
+        rows go in blocks of block_size and the columns in tiles of tile_size: the running
+        top-k of each block gets merged tile by tile, so only block_size x tile_size scores
+        are alive per job no matter how big N is (~16 MB of scores with the defaults,
+        embeddings can be a mmap, they are read a tile at a time).
+        tile_size=None scores all N columns at once, peak memory then grows with N.
+        n_jobs > 1 runs row blocks in threads, the matmuls release the GIL
+        '''
+        n_songs = len(embeddings)
+        k = min(k + 1, n_songs) #+1 because the song itself is always in its own top-k
+
+        if tile_size is None or tile_size >= n_songs:
+            embeddings = l2_normalize(embeddings)
+            norms = np.ones(n_songs, dtype=np.float32)
+            tile_size = n_songs
+        else:
+            norms = np.empty(n_songs, dtype=np.float32)
+            for start in range(0, n_songs, tile_size):
+                norms[start:start + tile_size] = np.linalg.norm(np.asarray(embeddings[start:start + tile_size], dtype=np.float32), axis=1)
+            norms[norms == 0] = 1.0
+
+        indices = np.empty((n_songs, k), dtype=np.int32)
+        scores = np.empty((n_songs, k), dtype=score_dtype)
+
+        def run_block(start: int):
+            stop = min(start + block_size, n_songs)
+            rows = np.asarray(embeddings[start:stop], dtype=np.float32) / norms[start:stop, None]
+            best_idx = np.empty((stop - start, 0), dtype=np.int64)
+            best_scores = np.empty((stop - start, 0), dtype=np.float32)
+            for col in range(0, n_songs, tile_size):
+                cols = np.asarray(embeddings[col:col + tile_size], dtype=np.float32) / norms[col:col + tile_size, None]
+                top = top_k(rows @ cols.T, k)
+                cand_idx = np.concatenate([best_idx, top.indices + col], axis=1)
+                cand_scores = np.concatenate([best_scores, top.scores], axis=1)
+                merged = top_k(cand_scores, k)
+                best_idx = np.take_along_axis(cand_idx, merged.indices, axis=1)
+                best_scores = merged.scores
+            indices[start:stop] = best_idx
+            scores[start:stop] = best_scores
+
+        starts = range(0, n_songs, block_size)
+        if n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                list(pool.map(run_block, starts))
+        else:
+            for start in starts:
+                run_block(start)
+
+        return cls(indices, scores)
+
+    def save(self, path: str):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "indices.npy", self.indices)
+        np.save(path / "scores.npy", self.scores)
+
+        print(f"neighbor index saved in: {path}")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "NeighborIndex":
+        path = Path(path)
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(path / "indices.npy", mmap_mode=mmap_mode),
+            np.load(path / "scores.npy", mmap_mode=mmap_mode)
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        path = Path(path)
+        return (path / "indices.npy").exists() and (path / "scores.npy").exists()
+
+    def neighbors(self, song_idx: int) -> TopK:
+        #O(1): one row of each array, straight from the mmap
+        return TopK(self.indices[song_idx], self.scores[song_idx])
+
+    def query(
+        self,
+        song_idx: int,
+        n: int = 10,
+        exclude_self: bool = True
+        ) -> list[tuple[int, float]]:
+        #at most k results, n bigger than that gets truncated
+        results = []
+        for idx, score in zip(self.indices[song_idx], self.scores[song_idx]):
+            if len(results) >= n:
+                break
+            if exclude_self and idx == song_idx:
+                continue
+            results.append((int(idx), float(score)))
+
+        return results
+
+
+def _segment_sums(vectors: np.ndarray, codes: np.ndarray, n_groups: int) -> np.ndarray:
+    #sum of the rows of every group: sort by group, then one np.add.reduceat over the runs
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sums = np.zeros((n_groups, vectors.shape[1]), dtype=np.float64)
+    if len(order):
+        sums[sorted_codes[starts]] = np.add.reduceat(vectors[order].astype(np.float64), starts, axis=0)
+    return sums
+
+
+class ArtistIndex:
+    '''
+    one centroid per artist: the mean of its (normalized) song vectors.
+    only sums and counts are stored, so adding or removing songs is a +/- on
+    a few rows, and the spread comes for free: 1 - |mean vector| is 0 when
+    every song points the same way and grows as the songs go apart.
+    rows is the artist position of every embedding row (set by build, saved with the
+    index) so a later version knows which artist a removed row belonged to;
+    add/remove don't know the row order, whoever calls them sets it again
+    '''
+
+    def __init__(self, names: list[str], sums: np.ndarray, counts: np.ndarray, rows: np.ndarray | None = None):
+        self.names = list(names)
+        self.sums = sums
+        self.counts = counts
+        self.rows = rows
+        self._positions = {name: i for i, name in enumerate(self.names)}
+        self._centroids = None
+        self._table = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def build(cls, embeddings, artists, block_size: int = 65536) -> "ArtistIndex":
+        #embeddings can be a mmap or a QuantizedEmbeddings, they're read block_size rows at a time
+        codes, names = pd.factorize(pd.Series(artists).fillna(""))
+        index = cls(names.tolist(), np.zeros((len(names), embeddings.shape[1]), dtype=np.float64),
+                    np.bincount(codes, minlength=len(names)).astype(np.int64), codes.astype(np.int32))
+        for start in range(0, len(codes), block_size):
+            block = l2_normalize(embeddings[start:start + block_size])
+            index.sums += _segment_sums(block, codes[start:start + block_size], len(names))
+        return index
+
+    def _update(self, embeddings: np.ndarray, artists: list[str], sign: int):
+        new = [a for a in dict.fromkeys(artists) if a not in self._positions]
+        if new:
+            self.names += new
+            self._positions.update({name: len(self._positions) + i for i, name in enumerate(new)})
+            self.sums = np.vstack([self.sums, np.zeros((len(new), self.sums.shape[1]))])
+            self.counts = np.concatenate([self.counts, np.zeros(len(new), dtype=np.int64)])
+        codes = np.array([self._positions[a] for a in artists], dtype=np.int64)
+        self.sums += sign * _segment_sums(l2_normalize(embeddings), codes, len(self.names))
+        self.counts += sign * np.bincount(codes, minlength=len(self.names))
+        self._centroids = self._table = None
+
+    def add(self, embeddings: np.ndarray, artists: list[str]):
+        #new songs (new artists get a row), costs the size of the new songs, not the catalogue
+        self._update(embeddings, artists, +1)
+
+    def remove(self, embeddings: np.ndarray, artists: list[str]):
+        #the same vectors that were added for songs that are gone / being replaced
+        self._update(embeddings, artists, -1)
+
+    @property
+    def centroids(self) -> np.ndarray:
+        if self._centroids is None:
+            self._centroids = l2_normalize(self.sums / np.maximum(self.counts, 1)[:, None])
+        return self._centroids
+
+    @property
+    def spreads(self) -> np.ndarray:
+        mean_length = np.linalg.norm(self.sums, axis=1) / np.maximum(self.counts, 1)
+        return (1.0 - mean_length).astype(np.float32)
+
+    def position(self, artist: str) -> int:
+        try:
+            return self._positions[artist]
+        except KeyError:
+            raise KeyError(f"unknown artist: {artist!r}") from None
+
+    def table(self) -> np.ndarray:
+        #full artist x artist cosine table, computed once (A x A float32)
+        if self._table is None:
+            self._table = cosine_scores(self.centroids, normalized=True)
+        return self._table
+
+    def similarity(self, artists: list[str]) -> np.ndarray:
+        #sub-table for a few artists, without building the full one
+        rows = self.centroids[[self.position(a) for a in artists]]
+        return cosine_scores(rows, normalized=True)
+
+    def most_similar(self, artist: str, n: int = 10) -> list[tuple[str, float]]:
+        i = self.position(artist)
+        scores = self._table[i] if self._table is not None else self.centroids @ self.centroids[i]
+        empty = self.counts <= 0
+        empty[i] = True
+        top = top_k(scores, n, exclude=empty)
+        return [(self.names[j], float(s)) for j, s in zip(top.indices, top.scores) if j >= 0]
+
+    def save(self, path: str):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "sums.npy", self.sums)
+        np.save(path / "counts.npy", self.counts)
+        if self.rows is not None:
+            np.save(path / "rows.npy", self.rows)
+        (path / "names.json").write_text(json.dumps(self.names, ensure_ascii=False))
+
+        print(f"artist index saved in: {path}")
+
+    @classmethod
+    def load(cls, path: str) -> "ArtistIndex":
+        path = Path(path)
+        rows = np.load(path / "rows.npy") if (path / "rows.npy").exists() else None #older indexes don't have it
+        return cls(json.loads((path / "names.json").read_text()), np.load(path / "sums.npy"), np.load(path / "counts.npy"), rows)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return (Path(path) / "names.json").exists()
+
+
+def most_similar_artists(artist: str, artist_index: ArtistIndex, n: int = 10) -> list[tuple[str, float]]:
+    return artist_index.most_similar(artist, n=n)
+
+
+def _kmeans(
+    vectors: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 20,
+    seed: int = 0,
+    block_size: int = 4096
+    ) -> np.ndarray:
+    #spherical k-means: vectors are normalized so nearest centroid = biggest dot product
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size] @ centroids.T
+            assignments[start:start + block_size] = block.argmax(axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+
+        #empty clusters get a random point so we don't lose them
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+
+        centroids = l2_normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    '''
+    approximate nearest neighbors with an inverted file:
+    songs are bucketed by their closest k-means centroid and a query
+    only scans the nprobe closest buckets instead of all N songs.
+    more nprobe = better recall, slower queries
+    '''
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_ids: np.ndarray,
+        list_vectors: np.ndarray,
+        nprobe: int = 8
+        ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets #list i lives in [offsets[i], offsets[i + 1])
+        self.list_ids = list_ids #song index of every row in list_vectors
+        self.list_vectors = list_vectors #normalized embeddings sorted by list
+        self.nprobe = nprobe
+
+        self.positions = np.empty(len(list_ids), dtype=np.int64)
+        self.positions[list_ids] = np.arange(len(list_ids))
+
+    def __len__(self) -> int:
+        return len(self.list_ids)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.centroids.nbytes + self.list_offsets.nbytes
+                + self.list_ids.nbytes + self.list_vectors.nbytes)
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        n_lists: int | None = None,
+        n_iter: int = 20,
+        nprobe: int = 8,
+        max_train: int = 64,
+        seed: int = 0
+        ) -> "IVFIndex":
+        normed = l2_normalize(embeddings)
+        n_songs = len(normed)
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(n_songs)))
+        n_lists = min(n_lists, n_songs)
+
+        #k-means only needs a sample, ~max_train points per list is plenty
+        rng = np.random.default_rng(seed)
+        n_train = min(n_songs, n_lists * max_train)
+        train = normed[rng.choice(n_songs, size=n_train, replace=False)]
+        centroids = _kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+
+        assignments = np.empty(n_songs, dtype=np.int64)
+        for start in range(0, n_songs, 4096):
+            block = normed[start:start + 4096] @ centroids.T
+            assignments[start:start + 4096] = block.argmax(axis=1)
+
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(counts, out=list_offsets[1:])
+
+        return cls(
+            centroids.astype(np.float32),
+            list_offsets,
+            order.astype(np.int32),
+            np.ascontiguousarray(normed[order]),
+            nprobe=nprobe
+        )
+
+    def save(self, path: str = "embeddings/ivf"):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "centroids.npy", self.centroids)
+        np.save(path / "list_offsets.npy", self.list_offsets)
+        np.save(path / "list_ids.npy", self.list_ids)
+        np.save(path / "list_vectors.npy", self.list_vectors)
+
+        print(f"ivf index saved in: {path}")
+
+    @classmethod
+    def load(cls, path: str = "embeddings/ivf", mmap: bool = True, nprobe: int = 8) -> "IVFIndex":
+        path = Path(path)
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(path / "centroids.npy"),
+            np.load(path / "list_offsets.npy"),
+            np.load(path / "list_ids.npy"),
+            np.load(path / "list_vectors.npy", mmap_mode=mmap_mode),
+            nprobe=nprobe
+        )
+
+    @staticmethod
+    def exists(path: str = "embeddings/ivf") -> bool:
+        return (Path(path) / "centroids.npy").exists()
+
+    def search(
+        self,
+        query_vec: np.ndarray,
+        n: int = 10,
+        nprobe: int | None = None
+        ) -> tuple[np.ndarray, np.ndarray]:
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        query_vec = l2_normalize(np.asarray(query_vec).reshape(1, -1))[0]
+
+        probe = top_k(self.centroids @ query_vec, nprobe).indices
+        ranges = [(self.list_offsets[i], self.list_offsets[i + 1]) for i in probe]
+        ranges = [(start, stop) for start, stop in ranges if stop > start]
+        if not ranges:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        ids = np.concatenate([self.list_ids[start:stop] for start, stop in ranges])
+        scores = np.concatenate([self.list_vectors[start:stop] @ query_vec for start, stop in ranges])
+
+        top = top_k(scores, n)
+        return ids[top.indices], top.scores
+
+    def query(
+        self,
+        song_idx: int,
+        n: int = 10,
+        exclude_self: bool = True,
+        nprobe: int | None = None
+        ) -> list[tuple[int, float]]:
+        query_vec = self.list_vectors[self.positions[song_idx]]
+        ids, scores = self.search(query_vec, n=n + int(exclude_self), nprobe=nprobe)
+
+        results = []
+        for idx, score in zip(ids, scores):
+            if len(results) >= n:
+                break
+            if exclude_self and idx == song_idx:
+                continue
+            results.append((int(idx), float(score)))
+
+        return results
+
+
+def quantized_similarities(
+    store: QuantizedEmbeddings,
+    query,
+    block_size: int = 8192
+    ) -> np.ndarray:
+    #cosine of one song (index) or vector against every row, straight from the int8/float16 codes.
+    #int8: x . q = sum_d codes[:, d] * (scales[d] * q[d]), so the scales get folded into the query
+    if isinstance(query, (int, np.integer)):
+        query = store.dequantize(query)
+    query = np.asarray(query, dtype=np.float32)
+    weighted = query * store.scales if store.scales is not None else query
+
+    scores = np.empty(len(store), dtype=np.float32)
+    for start in range(0, len(store), block_size):
+        block = np.asarray(store.codes[start:start + block_size], dtype=np.float32)
+        scores[start:start + block_size] = block @ weighted
+
+    denom = store.norms * max(float(np.linalg.norm(query)), 1e-12)
+    return scores / np.maximum(denom, 1e-12)
+
+
+def row_similarities(embeddings, song_idx: int, block_size: int = 8192) -> np.ndarray:
+    #exact cosine of one song against every row, in blocks so an mmap isn't copied whole
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return quantized_similarities(embeddings, song_idx, block_size)
+    query = np.asarray(embeddings[song_idx], dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    scores = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        norms = np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+        scores[start:start + block_size] = (block @ query) / norms
+    return scores
+
+
+def _dedup_pairs(pairs: list[tuple[int, float]], groups: np.ndarray, skip_group=None) -> list[tuple[int, float]]:
+    #pairs come best first, keep the first song of each group
+    if not pairs:
+        return []
+    ids = np.fromiter((idx for idx, _ in pairs), dtype=np.int64, count=len(pairs))
+    keys = groups[ids]
+    _, first = np.unique(keys, return_index=True)
+    keep = np.sort(first)
+    if skip_group is not None:
+        keep = keep[keys[keep] != skip_group]
+    return [pairs[i] for i in keep]
+
+
+@timed("find_most_similar")
 def find_most_similar(
     song_idx: int, 
-    similarity_matrix: np.ndarray, 
+    similarity_matrix, 
     n: int = 10,
-    exclude_self: bool = True
+    exclude_self: bool = True,
+    groups: np.ndarray | None = None,
+    embeddings=None
     ) -> list[tuple[int, float]]:
-    similarities = similarity_matrix[song_idx]
-    
-    sorted_indices = np.argsort(similarities)[::-1]
-    
-    results = []
-    for idx in sorted_indices:
-        if exclude_self and idx == song_idx:
-            continue
-        results.append((int(idx), float(similarities[idx])))
-        if len(results) >= n:
-            break
+    '''
+    similarity_matrix can be the dense N x N matrix, quantized embeddings or any index with a .query().
+    groups: one id per song (work_id from load_songs, or near_duplicate_groups), then only the best
+    song of each group is returned, and with exclude_self the other versions of the song itself go too.
+    embeddings (array or QuantizedEmbeddings): with an index and groups, if the index's k runs out
+    before n groups the row is scanned exactly instead, so there are always n results when n groups exist
+    '''
+    if groups is not None:
+        groups = np.asarray(groups)
+    skip_group = groups[song_idx] if groups is not None and exclude_self else None
+
+    if isinstance(similarity_matrix, QuantizedEmbeddings):
+        similarities = quantized_similarities(similarity_matrix, song_idx)
+    elif not isinstance(similarity_matrix, np.ndarray):
+        if groups is None:
+            return similarity_matrix.query(song_idx, n=n, exclude_self=exclude_self)
+        #indexes only give a prefix of the ranking: ask for more until there are n groups or it runs out
+        fetch = 2 * n
+        while True:
+            pairs = similarity_matrix.query(song_idx, n=fetch, exclude_self=exclude_self)
+            results = _dedup_pairs(pairs, groups, skip_group)
+            if len(results) >= n:
+                return results[:n]
+            if len(pairs) < fetch:
+                break
+            fetch *= 4
+        if embeddings is None:
+            return results
+        similarities = row_similarities(embeddings, song_idx)
+    else:
+        similarities = similarity_matrix[song_idx]
     
-    return results
+    exclude = None
+    if skip_group is not None:
+        exclude = groups == skip_group
+    elif exclude_self:
+        exclude = song_idx
+    top = top_k(similarities, n, exclude=exclude, groups=groups)
+    return [(int(idx), float(score)) for idx, score in zip(top.indices, top.scores) if idx >= 0]
+
+
+def near_duplicate_groups(
+    index: NeighborIndex,
+    threshold: float = 0.97,
+    groups: np.ndarray | None = None
+    ) -> np.ndarray:
+    '''
+    songs whose lyrics are almost the same embedding (covers, re-releases with another title...)
+    get the same group id. built from the precomputed neighbors, so it costs N * k.
+    groups (e.g. work_id) are merged in: two songs of the same work stay together
+    '''
+    from scipy.sparse import coo_matrix #comes with scikit-learn
+    from scipy.sparse.csgraph import connected_components
 
+    n_songs = len(index)
+    rows = np.repeat(np.arange(n_songs), index.k)
+    cols = np.asarray(index.indices).ravel()
+    close = np.asarray(index.scores, dtype=np.float32).ravel() >= threshold
+    rows, cols = rows[close], cols[close]
+    if groups is not None:
+        #link every song to the first song of its group
+        groups = np.asarray(groups)
+        _, first, inverse = np.unique(groups, return_index=True, return_inverse=True)
+        rows = np.concatenate([rows, np.arange(n_songs)])
+        cols = np.concatenate([cols, first[inverse]])
 
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n_songs, n_songs))
+    _, labels = connected_components(graph, directed=False)
+    return labels.astype(np.int64)
+
+
+@timed("calc_phrase_similarity")
 def calc_phrase_similarity(
     phrases1: list[str], 
     phrases2: list[str],
-    model
+    model,
+    cache=None
     ) -> np.ndarray:
     if not phrases1 or not phrases2:
         return np.array([[]])
     
-    emb1 = model.encode(phrases1, convert_to_numpy=True)
-    emb2 = model.encode(phrases2, convert_to_numpy=True)
+    #with a PhraseEmbeddingCache only unseen lines hit the model and the vectors come normalized
+    if cache is not None:
+        emb1 = cache.encode(phrases1, model)
+        emb2 = cache.encode(phrases2, model)
+        return emb1 @ emb2.T
     
-    return cosine_similarity(emb1, emb2)
+    record_encode(len(phrases1))
+    record_encode(len(phrases2))
+    with timed("model_encode"):
+        emb1 = model.encode(phrases1, convert_to_numpy=True)
+        emb2 = model.encode(phrases2, convert_to_numpy=True)
+    
+    return cosine_scores(emb1, emb2)
+    
+
+def calc_line_similarity(
+    song_idx1: int,
+    song_idx2: int,
+    line_embeddings: np.ndarray,
+    line_offsets: np.ndarray
+    ) -> np.ndarray:
+    #same result as calc_phrase_similarity but from the precomputed (normalized) lines, no model needed
+    emb1 = line_embeddings[line_offsets[song_idx1]:line_offsets[song_idx1 + 1]]
+    emb2 = line_embeddings[line_offsets[song_idx2]:line_offsets[song_idx2 + 1]]
+    if len(emb1) == 0 or len(emb2) == 0:
+        return np.array([[]])
+    return np.asarray(emb1) @ np.asarray(emb2).T
+    
+
+def encode_query(query: str, model, cache=None) -> np.ndarray:
+    #one normalized vector for a free-text query, repeated queries come from the cache's LRU
+    if cache is not None:
+        return cache.encode([query], model)[0]
+    record_encode(1)
+    with timed("model_encode"):
+        vec = np.asarray(model.encode([query], convert_to_numpy=True)[0], dtype=np.float32)
+    return vec / max(float(np.linalg.norm(vec)), 1e-12)
+
+
+def _search_rows(query_vec: np.ndarray, rows, n: int, norms: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    #top-n rows for a normalized query: dense matrix, quantized store or an index with .search() (IVFIndex)
+    if hasattr(rows, "search"):
+        return rows.search(query_vec, n=n)
+    if isinstance(rows, QuantizedEmbeddings):
+        scores = quantized_similarities(rows, query_vec)
+    else:
+        scores = rows @ query_vec
+        if norms is not None:
+            scores /= np.maximum(norms, 1e-12)
+    return top_k(scores, n)
+
+
+@timed("semantic_search")
+def semantic_search(
+    query_vec: np.ndarray,
+    embeddings,
+    n: int = 10,
+    norms: np.ndarray | None = None,
+    line_embeddings=None,
+    line_offsets: np.ndarray | None = None,
+    n_lines: int = 5,
+    normalized: bool = False
+    ) -> tuple[list[tuple[int, float]], list[tuple[int, int, float]]]:
+    '''
+    songs whose lyrics are closest to an (already encoded) query: [(song_idx, score)],
+    and if the precomputed lines are given, the closest lines: [(song_idx, line_idx, score)].
+    embeddings / line_embeddings can also be an IVFIndex for big catalogues.
+    pass norms (row norms of embeddings) when searching many times so they aren't recomputed,
+    or normalized=True if the rows already have norm 1 (manifest["normalized"])
+    '''
+    query_vec = np.asarray(query_vec, dtype=np.float32)
+    query_vec = query_vec / max(float(np.linalg.norm(query_vec)), 1e-12)
+
+    if norms is None and not normalized and isinstance(embeddings, np.ndarray):
+        norms = np.linalg.norm(embeddings, axis=1)
+    ids, scores = _search_rows(query_vec, embeddings, n, norms)
+    songs = [(int(i), float(score)) for i, score in zip(ids, scores)]
+
+    lines = []
+    if line_embeddings is not None and line_offsets is not None and len(line_embeddings):
+        #lines are stored normalized, no norms needed
+        ids, scores = _search_rows(query_vec, line_embeddings, n_lines)
+        owners = np.searchsorted(line_offsets, ids, side="right") - 1
+        lines = [
+            (int(song), int(row - line_offsets[song]), float(score))
+            for row, song, score in zip(ids, owners, scores)
+        ]
+
+    return songs, lines
     
 
 def get_top_phrase_pairs(
@@ -50,13 +801,5 @@ def get_top_phrase_pairs(
     n: int = 5
     ) -> list[tuple[str, str, float]]:
 
-    flat_indices = np.argsort(similarity_matrix.flatten())[::-1][:n]
-    
-    results = []
-    for flat_idx in flat_indices:
-        i = flat_idx // similarity_matrix.shape[1]
-        j = flat_idx % similarity_matrix.shape[1]
-        score = similarity_matrix[i, j]
-        results.append((phrases1[i], phrases2[j], float(score)))
-    
-    return results
\ No newline at end of file
+    (rows, cols), scores = top_k_cells(similarity_matrix, n)
+    return [(phrases1[i], phrases2[j], float(score)) for i, j, score in zip(rows, cols, scores)]
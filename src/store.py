@@ -0,0 +1,85 @@
+'''
+compact embedding storage: memory-mapped and optionally float16 / int8
+so several app processes can share the same pages and use less RAM
+'''
+import numpy as np
+from pathlib import Path
+
+class QuantizedEmbeddings:
+    '''
+    codes is the stored matrix (float16 or int8). for int8 every dimension d
+    has its own scale: x[:, d] ~= codes[:, d] * scales[d].
+    norms are the L2 norms of the dequantized rows, needed for cosine
+    '''
+
+    def __init__(self, codes: np.ndarray, norms: np.ndarray, scales: np.ndarray | None = None):
+        self.codes = codes
+        self.norms = norms
+        self.scales = scales
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.codes.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.codes.dtype
+
+    @property
+    def nbytes(self) -> int:
+        scales = 0 if self.scales is None else self.scales.nbytes
+        return self.codes.nbytes + self.norms.nbytes + scales
+
+    def dequantize(self, rows=slice(None)) -> np.ndarray:
+        x = np.asarray(self.codes[rows], dtype=np.float32)
+        if self.scales is not None:
+            x = x * self.scales
+        return x
+
+    def __getitem__(self, rows) -> np.ndarray:
+        return self.dequantize(rows)
+
+
+def quantize_embeddings(embeddings: np.ndarray, dtype: str = "int8") -> QuantizedEmbeddings:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    if dtype == "float16":
+        codes = embeddings.astype(np.float16)
+        scales = None
+    elif dtype == "int8":
+        #symmetric per-dimension scale, the biggest |value| of each dimension maps to 127
+        scales = np.abs(embeddings).max(axis=0) / 127
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(embeddings / scales), -127, 127).astype(np.int8)
+        scales = scales.astype(np.float32)
+    else:
+        raise ValueError(f"unknown dtype {dtype}, use 'float16' or 'int8'")
+
+    store = QuantizedEmbeddings(codes, np.empty(0, dtype=np.float32), scales)
+    store.norms = np.linalg.norm(store.dequantize(), axis=1).astype(np.float32)
+    return store
+
+def save_embedding_store(store: QuantizedEmbeddings, path: str):
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "codes.npy", store.codes)
+    np.save(path / "norms.npy", store.norms)
+    if store.scales is not None:
+        np.save(path / "scales.npy", store.scales)
+
+    print(f"{store.dtype} embeddings saved in: {path}")
+
+def load_embedding_store(path: str, mmap: bool = True) -> QuantizedEmbeddings:
+    path = Path(path)
+    scales = np.load(path / "scales.npy") if (path / "scales.npy").exists() else None
+    return QuantizedEmbeddings(
+        np.load(path / "codes.npy", mmap_mode="r" if mmap else None),
+        np.load(path / "norms.npy"),
+        scales
+    )
+
+def embedding_store_exists(path: str) -> bool:
+    return (Path(path) / "codes.npy").exists()
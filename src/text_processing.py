@@ -3,26 +3,105 @@ load and process texts
 '''
 import pandas as pd 
 import re 
+import hashlib
 from pathlib import Path 
+import numpy as np
+from .catalog import SongCatalog
+from .metrics import timed
 
-def load_songs(path: str = "data/songs.csv") -> pd.DataFrame:
+#compiled once, clean_lyrics runs on every song
+_BRACKETS = re.compile(r'\[.*?\]')
+_BLANK_LINES = re.compile(r'\n\s*\n')
+_SPACES = re.compile(r' {2,}') #' +' would also rewrite every single space, same result but much slower
+_LINE_END_CODES = np.array([ord(c) for c in '.!?,'], dtype=np.uint32)
+#whatever str.split() treats as whitespace (the highest one is U+3000)
+_IS_SPACE = np.array([chr(c).isspace() for c in range(0x3001)], dtype=bool)
+_SONG_SEP = "\n\0\n"
+
+@timed("load_songs")
+def load_songs(path: str = "data/cache/songs", columns: list[str] | None = None) -> SongCatalog:
+    #path can be the columnar cache folder made by src.ingest (fast) or a single csv.
+    #the result is a SongCatalog: the DataFrame with O(1) lookups by song_id / display_title
+    if Path(path).is_dir():
+        from .ingest import load_song_cache
+        df = load_song_cache(path, columns)
+        df["song_id"] = range(len(df)) #unique id for each song
+        if {"Artist", "Title"} <= set(df.columns):
+            df["work_id"] = make_work_ids(df)
+        return SongCatalog(df)
+    
     df = pd.read_csv(path)
     
     df["song_id"] = range(len(df)) #unique id for each song
+    df["song_key"] = make_song_keys(df) #same song -> same key, even if the csv order changes
     df["display_title"] =  df ["Artist"] + " - " + df["Title"]
-    return df
+    df["work_id"] = make_work_ids(df) #remixes / live versions of a song share it
+    if columns is not None:
+        df = df[list(dict.fromkeys(list(columns) + ["song_id", "work_id"]))]
+    return SongCatalog(df)
+
+def make_song_keys(df: pd.DataFrame) -> pd.Series:
+    base = (
+        df["Artist"].fillna("").astype(str) + "\x1f" +
+        df["Title"].fillna("").astype(str) + "\x1f" +
+        df["Album"].fillna("").astype(str)
+    )
+    #repeated artist/title/album (it happens) get #1, #2... in order of appearance
+    base = base + "#" + base.groupby(base).cumcount().astype(str)
+    return base.map(lambda s: hashlib.sha1(s.encode("utf-8")).hexdigest()[:16])
+
+def make_work_ids(df: pd.DataFrame) -> np.ndarray:
+    #same artist + title before the first "(" -> same work: "Song (Remix)", "song (Live)"...
+    artist = df["Artist"].fillna("").astype(str).str.lower()
+    title = df["Title"].fillna("").astype(str).str.split("(", n=1).str[0].str.strip().str.lower()
+    codes, _ = pd.factorize(artist + "\x1f" + title)
+    return codes.astype(np.int64)
 
 def clean_lyrics(text: str) -> str:
     if not isinstance(text, str):
         return ""
     
     #pure regex implementation to clean up lyrics
-    text = re.sub(r'\[.*?\]', '', text)
-    text = re.sub(r'\n\s*\n', '\n', text)
-    text = re.sub(r' +', ' ', text)
+    text = _BRACKETS.sub('', text)
+    text = _BLANK_LINES.sub('\n', text)
+    text = _SPACES.sub(' ', text)
     
     return text.strip()
 
+def _collapse_spaces(text: str) -> str:
+    #same as _SPACES.sub(' ', text): drop every space that comes right after another one,
+    #done on the code points with numpy because re is slow on millions of matches
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    is_space = codes == 32
+    drop = is_space[1:] & is_space[:-1]
+    if not drop.any():
+        return text
+    keep = np.r_[True, ~drop]
+    return codes[keep].tobytes().decode("utf-32-le")
+
+@timed("clean_lyrics_batch")
+def clean_lyrics_batch(texts, chunk_size: int = 256) -> pd.Series:
+    #same as clean_lyrics but over a whole column: every chunk of songs is glued
+    #into one string and each regex runs once per chunk (small chunks stay in cache).
+    #the separator has \n on both sides so no pattern can match across two songs
+    texts = [t if isinstance(t, str) else "" for t in texts]
+    if any("\0" in t for t in texts):
+        return pd.Series([clean_lyrics(t) for t in texts], dtype=object)
+    
+    cleaned = []
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start:start + chunk_size]
+        text = _SONG_SEP.join(chunk)
+        if "[" in text:
+            text = _BRACKETS.sub('', text)
+        if any("\n" in t for t in chunk):
+            text = _BLANK_LINES.sub('\n', text)
+        text = _collapse_spaces(text)
+        cleaned.extend(part.strip() for part in text.split("\0"))
+    
+    return pd.Series(cleaned, dtype=object)
+
+@timed("split_into_sentences")
 def split_into_sentences(text: str) -> list[str]:
     """
     Divide letras en frases/líneas.
@@ -70,8 +149,114 @@ def split_into_sentences(text: str) -> list[str]:
     
     return lines
 
-def get_song_by_id(df:pd.DataFrame, song_id: int) -> dict:
-    row = df[df["song_id"] == song_id]. iloc[0]
+@timed("split_into_sentences_batch")
+def split_into_sentences_batch(texts, chunk_size: int = 1024) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    split_into_sentences para muchas letras a la vez, mismo resultado.
+    Devuelve todas las líneas en un solo array + offsets:
+    las líneas de la letra i son lines[offsets[i]:offsets[i + 1]]
+    '''
+    cleaned = clean_lyrics_batch(texts).tolist()
+    parts = []
+    counts = []
+    # Por bloques de letras: los arrays por carácter caben mejor en caché
+    for start in range(0, len(cleaned), chunk_size):
+        lines, chunk_offsets = _split_cleaned(cleaned[start:start + chunk_size])
+        parts.append(lines)
+        counts.append(np.diff(chunk_offsets))
+    
+    offsets = np.zeros(len(cleaned) + 1, dtype=np.int64)
+    if not parts:
+        return np.empty(0, dtype=object), offsets
+    np.cumsum(np.concatenate(counts), out=offsets[1:])
+    return np.concatenate(parts), offsets
+
+def _split_cleaned(cleaned: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    n_texts = len(cleaned)
+    lines_per_song = {}
+    
+    # Letras con saltos de línea reales (pocas): igual que split_into_sentences
+    for i, text in enumerate(cleaned):
+        if '\n' in text:
+            lines = [line.strip() for line in text.split('\n') if len(line.strip()) > 3]
+            if len(lines) > 3:
+                lines_per_song[i] = lines
+    
+    # El resto: cortes cada ~60 caracteres o después de puntuación.
+    # Todo se pega en un solo texto y las palabras salen de máscaras de numpy
+    rest = [i for i in range(n_texts) if i not in lines_per_song]
+    joined = " ".join(cleaned[i] for i in rest)
+    song_starts = np.zeros(len(rest), dtype=np.int64)
+    np.cumsum([len(cleaned[i]) + 1 for i in rest[:-1]], out=song_starts[1:])
+    
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32)
+    lut = np.zeros(max(int(codes.max(initial=0)), len(_IS_SPACE) - 1) + 1, dtype=bool)
+    lut[:len(_IS_SPACE)] = _IS_SPACE
+    is_space = lut[codes]
+    
+    padded = np.r_[True, is_space, True]
+    word_starts = np.flatnonzero(~padded[1:-1] & padded[:-2])
+    word_ends = np.flatnonzero(~padded[1:-1] & padded[2:]) + 1
+    word_song = np.searchsorted(song_starts, word_starts, side='right') - 1
+    n_words = len(word_starts)
+    
+    # Cortes forzados: puntuación o última palabra de la letra
+    forced = np.isin(codes[word_ends - 1], _LINE_END_CODES)
+    forced[np.r_[word_song[1:] != word_song[:-1], True][:n_words]] = True
+    cum = np.r_[0, np.cumsum(word_ends - word_starts + 1)] #cum[i] = length before word i
+    
+    # Entre dos cortes forzados se corta cada vez que se llega a 60 caracteres.
+    # Todos esos tramos avanzan a la vez: una vuelta del while = una línea por tramo
+    run_ends = np.flatnonzero(forced) + 1
+    pointer = np.r_[0, run_ends[:-1]].astype(np.int64) if n_words else np.empty(0, dtype=np.int64)
+    starts, stops = [], []
+    while len(pointer):
+        stop = np.minimum(np.searchsorted(cum, cum[pointer] + 60, side='left'), run_ends)
+        starts.append(pointer)
+        stops.append(stop)
+        active = stop < run_ends
+        pointer, run_ends = stop[active], run_ends[active]
+    starts = np.concatenate(starts) if starts else np.empty(0, dtype=np.int64)
+    stops = np.concatenate(stops) if stops else np.empty(0, dtype=np.int64)
+    order = np.argsort(starts)
+    starts, stops = starts[order], stops[order]
+    
+    line_len = cum[stops] - cum[starts] - 1
+    keep = line_len > 5
+    starts, stops = starts[keep], stops[keep]
+    
+    # Si entre las palabras solo hay un espacio, la línea es un trozo del texto tal cual
+    span_a = word_starts[starts]
+    span_b = word_ends[stops - 1]
+    odd_space = np.flatnonzero(is_space & (codes != 32)) #\n, \t...
+    exact = (span_b - span_a == line_len[keep]) & (
+        np.searchsorted(odd_space, span_b) == np.searchsorted(odd_space, span_a)
+    )
+    word_lines = [
+        joined[a:b] if ok else ' '.join(joined[a:b].split())
+        for a, b, ok in zip(span_a.tolist(), span_b.tolist(), exact.tolist())
+    ]
+    
+    song_ids = np.asarray(rest, dtype=np.int64)[word_song[starts]] if rest else np.empty(0, dtype=np.int64)
+    counts = np.bincount(song_ids, minlength=n_texts)
+    for i, lines in lines_per_song.items():
+        counts[i] = len(lines)
+    
+    offsets = np.zeros(n_texts + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    all_lines = np.empty(offsets[-1], dtype=object)
+    
+    # word_lines ya vienen en orden de letra, se copian en sus huecos
+    positions = offsets[song_ids] + (np.arange(len(song_ids)) - np.searchsorted(song_ids, song_ids))
+    all_lines[positions] = word_lines
+    for i, lines in lines_per_song.items():
+        all_lines[offsets[i]:offsets[i + 1]] = lines
+    return all_lines, offsets
+
+def get_song_by_id(df: pd.DataFrame, song_id: int) -> dict:
+    #with the SongCatalog from load_songs this is a dict lookup, a plain DataFrame gets indexed first
+    catalog = df if isinstance(df, SongCatalog) else SongCatalog(df)
+    row = catalog.record(catalog.row_of(song_id), ["Artist", "Title", "Album", "Year", "Lyric", "display_title"])
     return {
         "song_id": song_id,
         "artist": row["Artist"],
@@ -82,10 +267,14 @@ def get_song_by_id(df:pd.DataFrame, song_id: int) -> dict:
         "display_title": row["display_title"]
     }
     
-def search_songs(df: pd.DataFrame, query: str) -> pd.DataFrame:
+def search_songs(df: pd.DataFrame, query: str, index=None, limit: int = 50) -> pd.DataFrame:
+    #with a SongSearchIndex (src.search_index) results are ranked and capped at limit
+    if index is not None:
+        return df.iloc[index.search(query, limit=limit)]
+    
     query = query.lower()
     mask = (
-        df["Title"].str.lower().str.contains(query, na=False) |
-        df["Artist"].str.lower().str.contains(query)
+        df["Title"].str.lower().str.contains(query, na=False, regex=False) |
+        df["Artist"].str.lower().str.contains(query, na=False, regex=False)
     )
     return df[mask]
\ No newline at end of file